@@ -0,0 +1,986 @@
+import argparse
+import asyncio
+import glob
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+from imageio import imread, imwrite
+
+import datasets
+import flow_transforms
+import models
+from checkpoint import load_checkpoint, save_file
+from datasets.listdataset import load_flo
+from flow_io import encode_flo
+from models.correlation.native import spatial_correlation
+from multiscaleloss import multiscaleEPE, realEPE
+from precision import PRECISIONS, autocast
+from serve import FlowClient, FlowServer, Metrics
+from serve import input_transform as inference_transform
+from streaming import StreamingFlow
+from tiling import TiledInference
+from util import AverageMeter, CheckpointWriter, CompiledStep, flow2rgb, flow_to_color, save_checkpoint
+
+
+parser = argparse.ArgumentParser(description='Micro benchmarks for the optical flow models and tools',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--device', type=str, default=None)
+parser.add_argument('--repeat', default=20, type=int, help='number of timed iterations')
+parser.add_argument('--warmup', default=3, type=int, help='number of untimed iterations')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_it(fn, device, repeat, warmup):
+    """returns the mean wall time of fn() in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    synchronize(device)
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device):
+    """peak allocated memory in MB since the last reset, only tracked on CUDA"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return float('nan')
+
+
+def print_table(header, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    print('  '.join(str(h).ljust(w) for h, w in zip(header, widths)))
+    for row in rows:
+        print('  '.join(str(x).ljust(w) for x, w in zip(row, widths)))
+
+
+def count_macs(model, *inputs):
+    """multiply-accumulates of all convolutions in one forward pass, grouped by the name of the direct child module"""
+    macs = {}
+    handles = []
+
+    def hook(name):
+        def fn(module, input, output):
+            kernel = module.weight[0].numel() if isinstance(module, nn.Conv2d) else module.weight[:, 0].numel()
+            macs[name] = macs.get(name, 0) + output.numel() * kernel
+        return fn
+
+    for name, module in model.named_modules():
+        if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d)):
+            handles.append(module.register_forward_hook(hook(name.split('.')[0])))
+    with torch.no_grad():
+        model(*inputs)
+    for handle in handles:
+        handle.remove()
+    return macs
+
+
+def add_dataset_arguments(sub):
+    sub.add_argument('--data', metavar='DIR', default=None,
+                     help='path to dataset, EPE is only reported if set')
+    sub.add_argument('--dataset', default='flying_chairs', choices=sorted(datasets.__all__))
+    sub.add_argument('--max-samples', default=200, type=int, help='number of validation pairs to evaluate')
+    sub.add_argument('--full-frames', action='store_true',
+                     help='do not center crop Sintel and KITTI validation frames')
+
+
+input_transform = transforms.Compose([
+    flow_transforms.ArrayToTensor(),
+    transforms.Normalize(mean=[0,0,0], std=[255,255,255]),
+    transforms.Normalize(mean=[0.45,0.432,0.411], std=[1,1,1])
+])
+
+
+def validation_set(args):
+    target_transform = flow_transforms.ArrayToTensor()
+    _, test_set = datasets.__dict__[args.dataset](args.data, transform=input_transform,
+                                                  target_transform=target_transform, split=None)
+    if args.full_frames:
+        test_set.co_transform = None
+    return test_set
+
+
+def evaluate_epe(model, args, device, div_flow, forward=None):
+    """mean EPE over the first --max-samples validation pairs, target flow is in pixels"""
+    if forward is None:
+        forward = model
+    sparse = 'KITTI' in args.dataset
+    loader = torch.utils.data.DataLoader(validation_set(args), batch_size=1, shuffle=False)
+    EPEs = AverageMeter()
+    model.eval()
+    with torch.no_grad():
+        for i, (input, target) in enumerate(loader):
+            if i >= args.max_samples:
+                break
+            target = target.to(device)
+            output = forward(torch.cat(input, 1).to(device))
+            EPEs.update(realEPE(div_flow * output, target, sparse=sparse).item(), target.size(0))
+    return EPEs.avg
+
+
+def bench_correlation(args, device):
+    """FlowNetC correlation (21x21 patch, dilation 2): native vs spatial_correlation_sampler"""
+    try:
+        from spatial_correlation_sampler import spatial_correlation_sample
+    except ImportError:
+        spatial_correlation_sample = None
+
+    def extension(input1, input2):
+        out = spatial_correlation_sample(input1, input2, kernel_size=1, patch_size=21,
+                                         stride=1, padding=0, dilation_patch=2)
+        b, ph, pw, h, w = out.size()
+        return out.view(b, ph * pw, h, w) / input1.size(1)
+
+    def native(input1, input2):
+        return spatial_correlation(input1, input2, max_displacement=10, dilation=2)
+
+    implementations = [('native', native)]
+    if spatial_correlation_sample is not None:
+        implementations.append(('extension', extension))
+    else:
+        print('=> spatial_correlation_sampler not found, only benchmarking the native implementation')
+
+    h, w = args.size
+    input1 = torch.randn(args.batch_size, args.channels, h, w, device=device, requires_grad=True)
+    input2 = torch.randn(args.batch_size, args.channels, h, w, device=device, requires_grad=True)
+
+    reference = None
+    rows = []
+    for name, fn in implementations:
+        def forward():
+            with torch.no_grad():
+                fn(input1, input2)
+
+        def forward_backward():
+            fn(input1, input2).sum().backward()
+
+        reset_peak_memory(device)
+        forward_ms = time_it(forward, device, args.repeat, args.warmup)
+        forward_mem = peak_memory(device)
+        reset_peak_memory(device)
+        backward_ms = time_it(forward_backward, device, args.repeat, args.warmup)
+        backward_mem = peak_memory(device)
+
+        with torch.no_grad():
+            output = fn(input1, input2)
+        if reference is None:
+            reference = output
+            error = 0.
+        else:
+            error = (output - reference).abs().max().item()
+        rows.append([name, '{:.2f}'.format(forward_ms), '{:.1f}'.format(forward_mem),
+                     '{:.2f}'.format(backward_ms), '{:.1f}'.format(backward_mem), '{:.2e}'.format(error)])
+
+    print_table(['impl', 'fwd ms', 'fwd MB', 'fwd+bwd ms', 'fwd+bwd MB', 'max |diff|'], rows)
+
+
+sub = subparsers.add_parser('correlation', help=bench_correlation.__doc__)
+sub.add_argument('--batch-size', '-b', default=4, type=int)
+sub.add_argument('--channels', default=256, type=int, help='feature channels, 256 for FlowNetC conv3')
+sub.add_argument('--size', default=[48, 64], type=int, nargs=2, metavar=('H', 'W'),
+                 help='feature map size, FlowNetC conv3 is 1/8 of the input resolution')
+sub.set_defaults(func=bench_correlation)
+
+
+def bench_pwcnet_search(args, device):
+    """PWCNet latency and decoder cost for several cost volume search ranges and strides"""
+    settings = []
+    for setting in args.settings:
+        search_range, search_stride = setting.split(':')
+        settings.append(([int(x) for x in search_range.split(',')], [int(x) for x in search_stride.split(',')]))
+
+    h, w = args.size
+    input = torch.randn(args.batch_size, 6, h, w, device=device)
+
+    rows = []
+    for search_range, search_stride in settings:
+        model = models.pwcnet(search_range=search_range, search_stride=search_stride).to(device).eval()
+        macs = count_macs(model.network, input[:, :3], input[:, 3:])
+        decoder_gmacs = sum(v for k, v in macs.items() if k in ['netSix', 'netFiv', 'netFou', 'netThr', 'netTwo']) / 1e9
+
+        def forward():
+            with torch.no_grad():
+                model(input)
+
+        latency = time_it(forward, device, args.repeat, args.warmup)
+        rows.append([','.join(map(str, search_range)), ','.join(map(str, search_stride)),
+                     '{:.2f}'.format(decoder_gmacs), '{:.2f}'.format(latency), ''])
+
+    # EPE only makes sense for weights trained with the same settings, evaluate the given checkpoints
+    for path in args.checkpoints:
+        network_data = load_checkpoint(path, map_location=device)
+        model = models.pwcnet(network_data).to(device)
+        div_flow = float(network_data.get('div_flow', 20))
+        epe = evaluate_epe(model, args, device, div_flow) if args.data is not None else float('nan')
+        rows.append([str(model.search_range), str(model.search_stride), '', '', '{:.3f}'.format(epe)])
+
+    print_table(['range', 'stride', 'decoder GMACs', 'latency ms', 'EPE'], rows)
+
+
+sub = subparsers.add_parser('pwcnet-search', help=bench_pwcnet_search.__doc__)
+sub.add_argument('--batch-size', '-b', default=1, type=int)
+sub.add_argument('--size', default=[448, 1024], type=int, nargs=2, metavar=('H', 'W'))
+sub.add_argument('--settings', default=['4:1', '3:1', '2:1', '2:2', '2,2,4,4,4:1,1,1,2,2'], nargs='+',
+                 help='RANGE:STRIDE pairs, each a single value or five comma separated values from level 2 to level 6')
+sub.add_argument('--checkpoints', default=[], nargs='*', metavar='PTH',
+                 help='trained pwcnet checkpoints to evaluate, their search settings are read from the file')
+add_dataset_arguments(sub)
+sub.set_defaults(func=bench_pwcnet_search)
+
+
+def bench_pwcnet_preprocess(args, device):
+    """PWCNet latency and EPE when resizing inputs to a multiple of 64 vs padding them"""
+    network_data = load_checkpoint(args.pretrained, map_location=device) if args.pretrained else None
+    div_flow = float(network_data.get('div_flow', 20)) if network_data is not None else 20.
+
+    h, w = args.size
+    input = torch.randn(args.batch_size, 6, h, w, device=device)
+
+    rows = []
+    for preprocess, pad_mode in [('resize', 'replicate'), ('pad', 'replicate'), ('pad', 'zero')]:
+        model = models.pwcnet(network_data, preprocess=preprocess, pad_mode=pad_mode).to(device).eval()
+
+        def forward():
+            with torch.no_grad():
+                model(input)
+
+        latency = time_it(forward, device, args.repeat, args.warmup)
+        if args.data is not None and network_data is not None:
+            epe = evaluate_epe(model, args, device, div_flow)
+        else:
+            epe = float('nan')
+        name = preprocess if preprocess == 'resize' else '{} ({})'.format(preprocess, pad_mode)
+        rows.append([name, '{:.2f}'.format(latency), '{:.3f}'.format(epe)])
+
+    print_table(['preprocess', 'latency ms', 'EPE'], rows)
+
+
+sub = subparsers.add_parser('pwcnet-preprocess', help=bench_pwcnet_preprocess.__doc__)
+sub.add_argument('--batch-size', '-b', default=1, type=int)
+sub.add_argument('--size', default=[436, 1024], type=int, nargs=2, metavar=('H', 'W'),
+                 help='input size, defaults to full Sintel frames')
+sub.add_argument('--pretrained', default=None, metavar='PTH', help='pwcnet checkpoint, required for EPE')
+add_dataset_arguments(sub)
+sub.set_defaults(func=bench_pwcnet_preprocess)
+
+
+def bench_warm_start(args, device):
+    """PWCNet on Sintel sequences: independent pairs vs streaming with feature reuse and temporal warm start"""
+    network_data = load_checkpoint(args.pretrained, map_location=device)
+    div_flow = float(network_data.get('div_flow', 20))
+    model = models.pwcnet(network_data).to(device).eval()
+
+    scenes = sorted(os.listdir(os.path.join(args.data, args.dataset_pass)))[:args.max_scenes]
+    modes = [('independent', None), ('reuse', None)] + [('warm@{}'.format(l), l) for l in args.levels]
+    totals = {name: [0, 0., []] for name, _ in modes}  # pairs, seconds, EPE per pair
+
+    for scene in scenes:
+        frame_files = sorted(glob.glob(os.path.join(args.data, args.dataset_pass, scene, '*.png')))
+        frames = [input_transform(imread(f)).unsqueeze(0).to(device) for f in frame_files]
+        flow_files = sorted(glob.glob(os.path.join(args.data, 'flow', scene, '*.flo')))
+        targets = [torch.from_numpy(load_flo(f).transpose(2, 0, 1).copy()).unsqueeze(0).to(device) for f in flow_files]
+
+        for name, level in modes:
+            stream = StreamingFlow(model, warm_start_level=level, refresh_interval=args.refresh_interval)
+            outputs = []
+            synchronize(device)
+            start = time.perf_counter()
+            with torch.no_grad():
+                if name == 'independent':
+                    for frame1, frame2 in zip(frames[:-1], frames[1:]):
+                        outputs.append(model(torch.cat([frame1, frame2], 1)))
+                else:
+                    for frame in frames:
+                        output = stream.push(frame)
+                        if output is not None:
+                            outputs.append(output)
+            synchronize(device)
+            totals[name][0] += len(outputs)
+            totals[name][1] += time.perf_counter() - start
+            totals[name][2].append([realEPE(div_flow * output, target).item() for output, target in zip(outputs, targets)])
+
+    rows = []
+    for name, _ in modes:
+        pairs, seconds, scene_EPEs = totals[name]
+        all_EPEs = [e for EPEs in scene_EPEs for e in EPEs]
+        # drift: EPE of the last quarter of every scene minus EPE of its first quarter
+        drift = [sum(EPEs[-max(len(EPEs) // 4, 1):]) / max(len(EPEs) // 4, 1) -
+                 sum(EPEs[:max(len(EPEs) // 4, 1)]) / max(len(EPEs) // 4, 1) for EPEs in scene_EPEs if EPEs]
+        rows.append([name, '{:.2f}'.format(pairs / seconds), '{:.3f}'.format(sum(all_EPEs) / len(all_EPEs)),
+                     '{:+.3f}'.format(sum(drift) / len(drift))])
+
+    print_table(['mode', 'pairs/s', 'EPE', 'EPE drift'], rows)
+
+
+sub = subparsers.add_parser('warm-start', help=bench_warm_start.__doc__)
+sub.add_argument('data', metavar='DIR', help='path to the Sintel training folder')
+sub.add_argument('pretrained', metavar='PTH', help='pwcnet checkpoint')
+sub.add_argument('--dataset-pass', default='clean', choices=['clean', 'final'])
+sub.add_argument('--levels', default=[5, 4], type=int, nargs='+', help='warm start levels to compare')
+sub.add_argument('--refresh-interval', default=10, type=int)
+sub.add_argument('--max-scenes', default=None, type=int)
+sub.set_defaults(func=bench_warm_start)
+
+
+def bench_tiling(args, device):
+    """tiled inference: throughput and seam error against untiled inference on sizes that still fit in memory"""
+    if args.pretrained:
+        network_data = load_checkpoint(args.pretrained, map_location=device)
+        model = models.get(network_data['arch'])(network_data).to(device).eval()
+    else:
+        model = models.get(args.arch)().to(device).eval()
+
+    if args.pair is not None:
+        pair = torch.cat([input_transform(imread(f)) for f in args.pair]).unsqueeze(0).to(device)
+
+    rows = []
+    for h, w in zip(args.sizes[::2], args.sizes[1::2]):
+        if args.pair is not None:
+            input = F.interpolate(pair, size=(h, w), mode='bilinear', align_corners=False)
+        else:
+            input = torch.randn(1, 6, h, w, device=device)
+        tiler = TiledInference(model, args.tile_size, overlap=args.overlap, memory_budget=args.memory_budget)
+
+        def untiled():
+            with torch.no_grad():
+                return F.interpolate(model(input), size=(h, w), mode='bilinear', align_corners=False)
+
+        reset_peak_memory(device)
+        tiled_ms = time_it(lambda: tiler(input), device, args.repeat, args.warmup)
+        tiled_mem = peak_memory(device)
+        tiled = tiler(input)
+        try:
+            reset_peak_memory(device)
+            untiled_ms = time_it(untiled, device, args.repeat, args.warmup)
+            untiled_mem = peak_memory(device)
+            reference = untiled()
+        except RuntimeError as e:  # out of memory
+            print('=> untiled inference failed at {}x{}: {}'.format(h, w, str(e).splitlines()[0]))
+            rows.append(['{}x{}'.format(h, w), len(tiler.tiles(h, w)), tiler.batch_size,
+                         '{:.2f}'.format(h * w / 1e3 / tiled_ms), '{:.0f}'.format(tiled_mem), '-', '-', '-', '-'])
+            continue
+
+        # seam region: pixels covered by more than one tile
+        coverage = torch.zeros(h, w, device=device)
+        for top, left, th, tw in tiler.tiles(h, w):
+            coverage[top:top + th, left:left + tw] += 1
+        error = torch.norm(tiled - reference, 2, 1)[0]
+        seam = coverage > 1
+        seam_error = error[seam].mean().item() if seam.any() else 0.
+        rows.append(['{}x{}'.format(h, w), len(tiler.tiles(h, w)), tiler.batch_size,
+                     '{:.2f}'.format(h * w / 1e3 / tiled_ms), '{:.0f}'.format(tiled_mem),
+                     '{:.2f}'.format(h * w / 1e3 / untiled_ms), '{:.0f}'.format(untiled_mem),
+                     '{:.4f}'.format(error.mean().item()), '{:.4f}'.format(seam_error)])
+
+    print_table(['size', 'tiles', 'batch', 'tiled MP/s', 'tiled MB', 'untiled MP/s', 'untiled MB',
+                 'mean diff', 'seam diff'], rows)
+
+
+sub = subparsers.add_parser('tiling', help=bench_tiling.__doc__)
+sub.add_argument('--arch', default='flownets', choices=['flownets', 'flownets_bn', 'flownetc', 'flownetc_bn', 'pwcnet'],
+                 help='architecture with random weights, if no checkpoint is given')
+sub.add_argument('--pretrained', default=None, metavar='PTH')
+sub.add_argument('--pair', default=None, nargs=2, metavar=('IMG1', 'IMG2'),
+                 help='image pair resized to every size, random inputs if not set')
+sub.add_argument('--sizes', default=[768, 1024, 1088, 1920, 2176, 3840], type=int, nargs='+', metavar='H W',
+                 help='list of H W input sizes')
+sub.add_argument('--tile-size', default=[384, 512], type=int, nargs=2, metavar=('H', 'W'))
+sub.add_argument('--overlap', default=128, type=int)
+sub.add_argument('--memory-budget', default=None, type=float, metavar='MB')
+sub.set_defaults(func=bench_tiling)
+
+
+def bench_flow_vis(args, device):
+    """flow visualization of a batch: per sample numpy flow2rgb vs batched flow_to_color"""
+    h, w = args.size
+    flow = 10 * torch.randn(args.batch_size, 2, h, w, device=device)
+
+    def numpy_loop():
+        for sample in flow:
+            (flow2rgb(sample, max_value=10) * 255).astype('uint8')
+
+    def batched():
+        flow_to_color(flow, max_value=10)
+
+    rows = []
+    for name, fn in [('flow2rgb', numpy_loop), ('flow_to_color', batched)]:
+        ms = time_it(fn, device, args.repeat, args.warmup)
+        rows.append([name, '{:.2f}'.format(ms), '{:.1f}'.format(args.batch_size * h * w / 1e3 / ms)])
+    print_table(['impl', 'ms/batch', 'MP/s'], rows)
+
+
+sub = subparsers.add_parser('flow-vis', help=bench_flow_vis.__doc__)
+sub.add_argument('--batch-size', '-b', default=8, type=int)
+sub.add_argument('--size', default=[384, 512], type=int, nargs=2, metavar=('H', 'W'))
+sub.set_defaults(func=bench_flow_vis)
+
+
+def bench_server(args, device):
+    """inference server: throughput, latency and batch sizes under concurrent local clients"""
+    model = models.get(args.arch)().to(device).eval()
+    sizes = list(zip(args.sizes[::2], args.sizes[1::2]))
+    rng = np.random.RandomState(0)
+    images = {size: rng.randint(0, 256, size=(2,) + size + (3,)).astype(np.uint8) for size in sizes}
+
+    async def client(port, index):
+        c = FlowClient(port=port)
+        await c.connect()
+        for i in range(args.requests):
+            img1, img2 = images[sizes[(index + i) % len(sizes)]]
+            await c.flow(img1, img2)
+        metrics = await c.metrics()
+        await c.close()
+        return metrics
+
+    @torch.no_grad()
+    def direct(img1, img2):
+        # normalized as in run_inference.py and serve.py, not as the training inputs
+        input_var = torch.cat([inference_transform(img1), inference_transform(img2)]).unsqueeze(0).to(device)
+        output = F.interpolate(model(input_var), size=input_var.size()[-2:], mode='bilinear', align_corners=False)
+        return (20 * output)[0].permute(1, 2, 0).cpu().numpy()
+
+    async def check(port):
+        # one request per size from every client at once, so that the flows come out of batches
+        async def request(size):
+            c = FlowClient(port=port)
+            await c.connect()
+            flow = await c.flow(*images[size])
+            await c.close()
+            return size, flow
+
+        results = await asyncio.gather(*[request(size) for size in sizes for _ in range(args.clients)])
+        return max(float(np.abs(flow - expected[size]).max()) for size, flow in results)
+
+    async def run(max_batch_size):
+        server = FlowServer(model, device, max_batch_size=max_batch_size, max_latency=args.max_latency / 1000)
+        await server.start()
+        tcp_server = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = tcp_server.sockets[0].getsockname()[1]
+        difference = await check(port)
+        server.metrics = Metrics()
+        start = time.perf_counter()
+        await asyncio.gather(*[client(port, i) for i in range(args.clients)])
+        seconds = time.perf_counter() - start
+        tcp_server.close()
+        await server.stop()
+        return seconds, server.metrics.as_dict(), difference
+
+    # the flows returned to the clients have to match a direct forward pass of each pair
+    expected = {size: direct(*images[size]) for size in sizes}
+    rows = []
+    for max_batch_size in args.max_batch_sizes:
+        seconds, metrics, difference = asyncio.run(run(max_batch_size))
+        if difference > 1e-2:
+            raise RuntimeError('server flows differ from direct inference by up to {:.2e} px'.format(difference))
+        print('=> max batch {}: server flows match direct inference, max difference {:.2e} px'
+              .format(max_batch_size, difference))
+        rows.append([max_batch_size, '{:.2f}'.format(metrics['requests'] / seconds),
+                     '{:.1f}'.format(metrics['mean_latency_ms']), '{:.2f}'.format(metrics['mean_batch_size']),
+                     metrics['max_queue_depth']])
+    print_table(['max batch', 'pairs/s', 'latency ms', 'mean batch', 'max queue'], rows)
+
+
+sub = subparsers.add_parser('server', help=bench_server.__doc__)
+sub.add_argument('--arch', default='flownets', choices=['flownets', 'flownets_bn', 'flownetc', 'flownetc_bn', 'pwcnet'])
+sub.add_argument('--clients', default=8, type=int, help='number of concurrent clients')
+sub.add_argument('--requests', default=10, type=int, help='number of requests per client')
+sub.add_argument('--sizes', default=[256, 320, 384, 512], type=int, nargs='+', metavar='H W',
+                 help='list of H W input sizes, clients cycle through them')
+sub.add_argument('--max-batch-sizes', default=[1, 4, 8], type=int, nargs='+')
+sub.add_argument('--max-latency', default=10, type=float, metavar='MS')
+sub.set_defaults(func=bench_server)
+
+
+def bench_checkpoint_load(args, device):
+    """checkpoint loading: torch.load vs memory mapped .safetensors, up to a ready model on the device"""
+    if args.pretrained:
+        state = load_checkpoint(args.pretrained, map_location='cpu')
+    else:
+        state = {'arch': args.arch, 'state_dict': models.get(args.arch)().state_dict(), 'div_flow': 20}
+    arch = state['arch']
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [('pth.tar', os.path.join(tmp, 'checkpoint.pth.tar')),
+                 ('safetensors', os.path.join(tmp, 'checkpoint.safetensors'))]
+        torch.save(state, paths[0][1])
+        save_file(state, paths[1][1])
+        for name, path in paths:
+            def load():
+                return load_checkpoint(path)
+
+            def load_model():
+                return models.get(arch)(load_checkpoint(path)).to(device)
+
+            load_ms = time_it(load, device, args.repeat, args.warmup)
+            model_ms = time_it(load_model, device, args.repeat, args.warmup)
+            rows.append([name, '{:.1f}'.format(os.path.getsize(path) / 2**20), '{:.2f}'.format(load_ms),
+                         '{:.2f}'.format(model_ms)])
+    print('=> files are in the page cache, drop it to measure a cold start from disk')
+    print_table(['format', 'MB', 'load ms', 'load + model ms'], rows)
+
+
+sub = subparsers.add_parser('checkpoint-load', help=bench_checkpoint_load.__doc__)
+sub.add_argument('--arch', default='pwcnet', choices=models.model_names,
+                 help='architecture with random weights, if no checkpoint is given')
+sub.add_argument('--pretrained', default=None, metavar='PTH')
+sub.set_defaults(func=bench_checkpoint_load)
+
+
+def bench_checkpoint_save(args, device):
+    """time the training loop is blocked by saving a checkpoint: synchronous save_checkpoint vs CheckpointWriter"""
+    model = models.get(args.arch)().to(device)
+    state = {'epoch': 1, 'arch': args.arch, 'state_dict': model.state_dict(), 'div_flow': 20}
+    extension = '.' + args.format if args.format == 'safetensors' else '.pth.tar'
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        sync_ms = time_it(lambda: save_checkpoint(state, True, tmp, 'checkpoint' + extension),
+                          device, args.repeat, args.warmup)
+        rows.append(['save_checkpoint', '{:.1f}'.format(sync_ms), '-'])
+
+        writer = CheckpointWriter(tmp, keep=args.keep, extension=extension)
+        epochs = iter(range(args.repeat + args.warmup))
+        blocked = []
+
+        def save():
+            start = time.perf_counter()
+            writer.save(state, True, next(epochs))
+            blocked.append(1000 * (time.perf_counter() - start))
+            # leave time for the background write, as an epoch of training would
+            time.sleep(sync_ms / 1000)
+
+        time_it(save, device, args.repeat, args.warmup)
+        writer.close()
+        rows.append(['CheckpointWriter', '{:.1f}'.format(np.mean(blocked[args.warmup:])),
+                     len(glob.glob(os.path.join(tmp, 'checkpoint_*' + extension)))])
+    print_table(['writer', 'blocked ms', 'checkpoints kept'], rows)
+
+
+sub = subparsers.add_parser('checkpoint-save', help=bench_checkpoint_save.__doc__)
+sub.add_argument('--arch', default='pwcnet', choices=models.model_names)
+sub.add_argument('--format', default='pth', choices=['pth', 'safetensors'])
+sub.add_argument('--keep', default=3, type=int)
+sub.set_defaults(func=bench_checkpoint_save)
+
+
+def count_allocations(fn, device):
+    """number and MB of the memory allocations of fn(), from the CUDA allocator statistics or the CPU profiler"""
+    if device.type == 'cuda':
+        synchronize(device)
+        before = torch.cuda.memory_stats(device)
+        fn()
+        synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        return (after['allocation.all.allocated'] - before['allocation.all.allocated'],
+                (after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated']) / 2**20)
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    allocations = [event.cpu_memory_usage for event in prof.events()
+                   if event.name == '[memory]' and event.cpu_memory_usage > 0]
+    return len(allocations), sum(allocations) / 2**20
+
+
+def bench_pwcnet_decoder_buffer(args, device):
+    """PWCNet decoders without autograd: preallocated feature buffer vs torch.cat of every conv output"""
+    model = models.get('pwcnet')().to(device).eval()
+    decoders = [module for module in model.modules() if hasattr(module, 'boolBuffer')]
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        input = torch.randn(batch_size, 6, *args.size, device=device)
+        with torch.no_grad():
+            features = model.encode(input[:, :3]), model.encode(input[:, 3:])
+
+        outputs = {}
+        for name, enabled in [('torch.cat', False), ('buffer', True)]:
+            for decoder in decoders:
+                decoder.boolBuffer = enabled
+
+            def decode():
+                with torch.no_grad():
+                    return model.decode(*features)
+
+            outputs[name] = decode()
+            decode_ms = time_it(decode, device, args.repeat, args.warmup)
+            allocations, allocated_mb = count_allocations(decode, device)
+            rows.append([batch_size, name, '{:.2f}'.format(decode_ms), '{:.2f}'.format(decode_ms / batch_size),
+                         allocations, '{:.0f}'.format(allocated_mb)])
+        print('=> batch size {}, max difference of the flows: {:.2e}'.format(
+            batch_size, (outputs['torch.cat'] - outputs['buffer']).abs().max().item()))
+    print('=> {}x{} inputs'.format(*args.size))
+    print_table(['batch', 'decoder features', 'decode ms', 'ms per pair', 'allocations', 'allocated MB'], rows)
+
+
+sub = subparsers.add_parser('pwcnet-decoder-buffer', help=bench_pwcnet_decoder_buffer.__doc__)
+sub.add_argument('--batch-sizes', default=[1, 4], type=int, nargs='+')
+sub.add_argument('--size', default=[436, 1024], type=int, nargs=2, metavar=('H', 'W'))
+sub.set_defaults(func=bench_pwcnet_decoder_buffer)
+
+
+def saved_activations(fn):
+    """MB of the tensors autograd keeps for backward while running fn(), counted once per storage.
+    Tensors saved inside checkpointed stages are not kept and not counted, their inputs are"""
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values()) / 2**20
+
+
+def bench_activation_checkpointing(args, device):
+    """training step with and without activation checkpointing: peak memory, saved activations and step time"""
+    input = torch.randn(args.batch_size, 6, *args.size, device=device)
+    target = torch.randn(args.batch_size, 2, *args.size, device=device)
+
+    rows = []
+    for arch in args.archs:
+        model = models.get(arch)().to(device).train()
+        for enabled in [False, True]:
+            model.checkpoint_activations = enabled
+
+            def step():
+                output = model(input)
+                output = output if isinstance(output, (list, tuple)) else [output]
+                loss = multiscaleEPE(output, target, weights=[1] * len(output))
+                model.zero_grad()
+                loss.backward()
+
+            saved_mb = saved_activations(lambda: model(input))
+            reset_peak_memory(device)
+            step_ms = time_it(step, device, args.repeat, args.warmup)
+            rows.append([arch, 'on' if enabled else 'off', '{:.0f}'.format(saved_mb),
+                         '{:.0f}'.format(peak_memory(device)), '{:.1f}'.format(step_ms)])
+    print('=> batch size {}, {}x{} inputs, peak memory is only tracked on CUDA'.format(args.batch_size, *args.size))
+    print_table(['arch', 'checkpointing', 'saved MB', 'peak MB', 'step ms'], rows)
+
+
+sub = subparsers.add_parser('activation-checkpointing', help=bench_activation_checkpointing.__doc__)
+sub.add_argument('--archs', default=['flownets', 'flownetc', 'pwcnet'], nargs='+', choices=models.model_names)
+sub.add_argument('--batch-size', default=4, type=int)
+sub.add_argument('--size', default=[320, 448], type=int, nargs=2, metavar=('H', 'W'))
+sub.set_defaults(func=bench_activation_checkpointing)
+
+
+def bench_precision(args, device):
+    """float32 vs bfloat16 autocast: inference latency, training step time, memory and EPE"""
+    if args.pretrained:
+        checkpoints = [load_checkpoint(path, map_location=device) for path in args.pretrained]
+    else:
+        checkpoints = [{'arch': arch} for arch in args.archs]
+    input = torch.randn(args.batch_size, 6, *args.size, device=device)
+    target = torch.randn(args.batch_size, 2, *args.size, device=device)
+
+    rows = []
+    for network_data in checkpoints:
+        arch = network_data['arch']
+        model = models.get(arch)(network_data if 'state_dict' in network_data else None).to(device)
+        div_flow = float(network_data.get('div_flow', 20))
+        for precision in PRECISIONS:
+            def forward(x):
+                with autocast(device, precision):
+                    return model(x).float()
+
+            def inference():
+                with torch.no_grad():
+                    forward(input)
+
+            def step():
+                with autocast(device, precision):
+                    output = model(input)
+                    output = output if isinstance(output, (list, tuple)) else [output]
+                    loss = multiscaleEPE(output, target, weights=[1] * len(output))
+                model.zero_grad()
+                loss.backward()
+
+            model.eval()
+            inference_ms = time_it(inference, device, args.repeat, args.warmup)
+            model.train()
+            reset_peak_memory(device)
+            step_ms = time_it(step, device, args.repeat, args.warmup)
+            saved_mb = saved_activations(step)
+            if args.data is not None and 'state_dict' in network_data:
+                epe = evaluate_epe(model, args, device, div_flow, forward=forward)
+            else:
+                epe = float('nan')
+            rows.append([arch, precision, '{:.2f}'.format(inference_ms), '{:.1f}'.format(step_ms),
+                         '{:.0f}'.format(saved_mb), '{:.0f}'.format(peak_memory(device)), '{:.3f}'.format(epe)])
+    print('=> batch size {}, {}x{} inputs, peak memory is only tracked on CUDA'.format(args.batch_size, *args.size))
+    print_table(['arch', 'precision', 'inference ms', 'train step ms', 'saved MB', 'peak MB', 'EPE'], rows)
+
+
+sub = subparsers.add_parser('precision', help=bench_precision.__doc__)
+sub.add_argument('--archs', default=['flownets', 'pwcnet'], nargs='+', choices=models.model_names,
+                 help='architectures with random weights, if no checkpoint is given')
+sub.add_argument('--pretrained', default=None, nargs='*', metavar='PTH',
+                 help='checkpoints to compare, EPE is only reported for them')
+sub.add_argument('--batch-size', default=4, type=int)
+sub.add_argument('--size', default=[320, 448], type=int, nargs=2, metavar=('H', 'W'))
+add_dataset_arguments(sub)
+sub.set_defaults(func=bench_precision)
+
+
+def bench_compile(args, device):
+    """eager vs torch.compile training step (model and multiscale loss): warm-up time and steady state throughput"""
+    input = torch.randn(args.batch_size, 6, *args.size, device=device)
+    target = torch.randn(args.batch_size, 2, *args.size, device=device)
+
+    def loss(model, input, target):
+        output = model(input)
+        output = output if isinstance(output, (list, tuple)) else [output]
+        return multiscaleEPE(output, target, weights=[1] * len(output))
+
+    rows = []
+    for arch in args.archs:
+        for name in ['eager', 'compiled']:
+            torch.manual_seed(0)
+            model = models.get(arch)().to(device).train()
+            compute_loss = loss if name == 'eager' else CompiledStep(loss)
+
+            def step():
+                model.zero_grad()
+                compute_loss(model, input, target).backward()
+
+            # the first step compiles the forward and backward graphs
+            synchronize(device)
+            start = time.perf_counter()
+            step()
+            synchronize(device)
+            warmup = time.perf_counter() - start
+            step_ms = time_it(step, device, args.repeat, args.warmup)
+            if name == 'compiled' and compute_loss.compiled is None:
+                name = 'compiled (fell back to eager)'
+            rows.append([arch, name, '{:.1f}'.format(warmup), '{:.1f}'.format(step_ms),
+                         '{:.1f}'.format(1000 * args.batch_size / step_ms)])
+    print('=> batch size {}, {}x{} inputs'.format(args.batch_size, *args.size))
+    print_table(['arch', 'step', 'warm-up s', 'steady step ms', 'steady pairs/s'], rows)
+
+
+sub = subparsers.add_parser('compile', help=bench_compile.__doc__)
+sub.add_argument('--archs', default=['flownets', 'pwcnet'], nargs='+', choices=models.model_names)
+sub.add_argument('--batch-size', default=4, type=int)
+sub.add_argument('--size', default=[320, 448], type=int, nargs=2, metavar=('H', 'W'))
+sub.set_defaults(func=bench_compile)
+
+
+def ddp_worker(rank, world_size, port, args, results):
+    """one process of bench_ddp_scaling: synthetic training steps of a DistributedDataParallel model on gloo"""
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(args.threads)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    model = nn.parallel.DistributedDataParallel(models.get(args.arch)(), bucket_cap_mb=args.bucket_cap_mb)
+    optimizer = torch.optim.Adam(model.parameters(), 1e-4)
+    input = torch.randn(args.batch_size, 6, *args.size)
+    target = torch.randn(args.batch_size, 2, *args.size)
+    model.train()
+
+    def step():
+        output = model(input)
+        output = output if isinstance(output, (list, tuple)) else [output]
+        loss = multiscaleEPE(output, target, weights=[1] * len(output))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    step_ms = time_it(step, torch.device('cpu'), args.repeat, args.warmup)
+    if rank == 0:
+        results.put(step_ms)
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp_scaling(args, device):
+    """distributed data parallel training on one machine with the gloo backend: throughput and scaling efficiency
+    from 1 to N processes, with a fixed batch size per process"""
+    cores = os.cpu_count()
+    context = mp.get_context('spawn')
+    rows = []
+    baseline = None
+    for world_size in args.processes:
+        args.threads = args.threads_per_process or max(1, cores // world_size)
+        results = context.SimpleQueue()
+        # a new port for every run, the previous one may still be in TIME_WAIT
+        mp.spawn(ddp_worker, args=(world_size, args.port + world_size, args, results), nprocs=world_size)
+        step_ms = results.get()
+        pairs_per_second = 1000 * world_size * args.batch_size / step_ms
+        if baseline is None:
+            baseline = pairs_per_second / world_size
+        rows.append([world_size, args.threads, '{:.1f}'.format(step_ms), '{:.1f}'.format(pairs_per_second),
+                     '{:.2f}'.format(pairs_per_second / baseline),
+                     '{:.0f}%'.format(100 * pairs_per_second / (baseline * world_size))])
+    print('=> {} on {} cores, batch size {} per process, {}x{} crops'.format(args.arch, cores, args.batch_size,
+                                                                          *args.size))
+    print_table(['processes', 'threads', 'step ms', 'pairs/s', 'speedup', 'efficiency'], rows)
+
+
+sub = subparsers.add_parser('ddp-scaling', help=bench_ddp_scaling.__doc__)
+sub.add_argument('--arch', default='flownets', choices=models.model_names)
+sub.add_argument('--processes', default=[1, 2, 4], type=int, nargs='+',
+                 help='numbers of processes to compare, efficiency is relative to the first one')
+sub.add_argument('--threads-per-process', default=None, type=int,
+                 help='torch threads of every process, the cores are split between the processes if not set')
+sub.add_argument('--batch-size', default=4, type=int, help='batch size per process')
+sub.add_argument('--size', default=[320, 448], type=int, nargs=2, metavar=('H', 'W'))
+sub.add_argument('--bucket-cap-mb', default=25, type=float)
+sub.add_argument('--port', default=29600, type=int, help='base port of the process groups')
+sub.set_defaults(func=bench_ddp_scaling)
+
+
+def write_synthetic_chairs(root, samples, size=(384, 512)):
+    """random image pairs and flows in the FlyingChairs layout, with a split file keeping 1 pair in 4 for validation"""
+    os.makedirs(root)
+    rng = np.random.RandomState(0)
+    for i in range(samples):
+        for name in ['img1', 'img2']:
+            imwrite(os.path.join(root, '{:05d}_{}.ppm'.format(i, name)),
+                    rng.randint(0, 256, size=size + (3,)).astype(np.uint8))
+        with open(os.path.join(root, '{:05d}_flow.flo'.format(i)), 'wb') as f:
+            f.write(encode_flo(rng.randn(1, *size, 2))[0])
+    split_file = os.path.join(root, 'split.txt')
+    with open(split_file, 'w') as f:
+        f.write('\n'.join('0' if i % 4 == 0 else '1' for i in range(samples)))
+    return split_file
+
+
+def bench_ddp_main(args, device):
+    """main.py itself trained with 1 to N processes on gloo, on synthetic FlyingChairs: rank split, seed broadcast,
+    reduced meters, validation in the first process and checkpoints, with the step time of every run"""
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    cores = os.cpu_count()
+    rows = []
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, 'chairs')
+        samples = 4 * max(args.processes) * args.batch_size * (args.iterations + 1)
+        split_file = write_synthetic_chairs(data, samples)
+        for world_size in args.processes:
+            threads = args.threads_per_process or max(1, cores // world_size)
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads), WANDB_MODE='disabled')
+            command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node',
+                       str(world_size), main_py, data, '--dataset', 'flying_chairs', '--arch', args.arch,
+                       '-s', split_file, '-b', str(args.batch_size), '--epochs', '1',
+                       '--epoch-size', str(args.iterations), '--print-freq', '1', '-j', str(args.workers), '--device', 'cpu',
+                       '--dist-backend', 'gloo', '--no-date', '--snapshot-interval', '0']
+            start = time.perf_counter()
+            # every run writes its checkpoints to a folder of its own
+            run_dir = os.path.join(tmp, 'run{}'.format(world_size))
+            os.makedirs(run_dir)
+            output = subprocess.run(command, cwd=run_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            seconds = time.perf_counter() - start
+            log = output.stdout.decode(errors='replace')
+            if output.returncode != 0:
+                print(log)
+                raise RuntimeError('main.py with {} processes failed'.format(world_size))
+            if world_size > 1 and 'distributed training with {} processes'.format(world_size) not in log:
+                raise RuntimeError('main.py did not train with {} processes'.format(world_size))
+            # per batch times of the first process, the first batch is a warm-up
+            batch_times = [float(t) for t in re.findall(r'Epoch: \[0\]\[\d+/\d+\]\t Time ([\d.]+)', log)][1:]
+            epes = re.findall(r'\* EPE ([\d.]+)', log)
+            step_ms = 1000 * sum(batch_times) / max(len(batch_times), 1)
+            pairs_per_second = 1000 * world_size * args.batch_size / step_ms
+            if baseline is None:
+                baseline = pairs_per_second / world_size
+            rows.append([world_size, threads, len(batch_times) + 1, '{:.0f}'.format(step_ms),
+                         '{:.2f}'.format(pairs_per_second), '{:.2f}'.format(pairs_per_second / baseline),
+                         '{:.0f}%'.format(100 * pairs_per_second / (baseline * world_size)),
+                         epes[-1] if epes else '-', '{:.0f}'.format(seconds)])
+    print('=> {} on {} cores, batch size {} per process, {} synthetic pairs'.format(args.arch, cores,
+                                                                                  args.batch_size, samples))
+    print_table(['processes', 'threads', 'batches', 'step ms', 'pairs/s', 'speedup', 'efficiency', 'val EPE',
+                 'run s'], rows)
+
+
+sub = subparsers.add_parser('ddp-main', help=bench_ddp_main.__doc__)
+sub.add_argument('--arch', default='flownets', choices=models.model_names)
+sub.add_argument('--processes', default=[1, 2], type=int, nargs='+',
+                 help='numbers of processes to compare, efficiency is relative to the first one')
+sub.add_argument('--threads-per-process', default=None, type=int,
+                 help='torch threads of every process, the cores are split between the processes if not set')
+sub.add_argument('--batch-size', default=1, type=int, help='batch size per process')
+sub.add_argument('--iterations', default=2, type=int, help='training batches per run, after the first one')
+sub.add_argument('--workers', default=0, type=int,
+                 help='data loading workers of every process, each one holds a copy of the process memory')
+sub.set_defaults(func=bench_ddp_main)
+
+
+HEAVY_MODULES = ['cupy', 'spatial_correlation_sampler', 'wandb', 'tensorboardX', 'torchvision']
+
+
+def bench_import_time(args, device):
+    """startup time of the scripts and of the model registry, each measured in a fresh interpreter"""
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    probe = ('import sys, time; start = time.perf_counter(); {}; '
+             'print(time.perf_counter() - start); print(",".join(m for m in {} if m in sys.modules))')
+    statements = [('import torch', 'import torch'),
+                  ('import models', 'import models'),
+                  ("models.get('flownets')", "import models; models.get('flownets')"),
+                  ("models.get('flownetc')", "import models; models.get('flownetc')"),
+                  ("models.get('pwcnet')", "import models; models.get('pwcnet')")]
+
+    rows = []
+    for name, statement in statements:
+        times = []
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, '-c', probe.format(statement, HEAVY_MODULES)],
+                                             cwd=code_dir, stderr=subprocess.DEVNULL).decode().split('\n')
+            times.append(1000 * float(output[0]))
+        rows.append([name, '{:.0f}'.format(min(times)), output[1] or '-'])
+
+    # the scripts import everything they need before parsing arguments, --help exits right after
+    for script in ['main.py', 'run_inference.py', 'serve.py']:
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, script, '--help'], cwd=code_dir,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(1000 * (time.perf_counter() - start))
+        rows.append(['{} --help'.format(script), '{:.0f}'.format(min(times)), 'n/a'])
+
+    print_table(['import', 'best ms', 'heavy modules loaded'], rows)
+
+
+sub = subparsers.add_parser('import-time', help=bench_import_time.__doc__)
+sub.add_argument('--runs', default=5, type=int, help='fresh interpreters per measurement, the best time is reported')
+sub.set_defaults(func=bench_import_time)
+
+
+def main():
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.error('please choose a benchmark')
+    if args.device is not None:
+        device = torch.device(args.device)
+    else:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    args.func(args, device)
+
+
+if __name__ == '__main__':
+    main()
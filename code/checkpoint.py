@@ -0,0 +1,135 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+import torch
+
+'''
+Flat checkpoint format with a tensor index, following the safetensors layout
+(https://github.com/huggingface/safetensors):
+
+    8 bytes: little endian u64, size N of the header
+    N bytes: JSON header {name: {"dtype": "F32", "shape": [...], "data_offsets": [begin, end]},
+                          "__metadata__": {key: value}}, padded with spaces
+    rest:    raw little endian tensor data, offsets are relative to the end of the header
+
+Tensors are loaded as views of a memory map of the file, nothing is read until load_state_dict copies
+them into the model. Checkpoints are dicts as saved by main.py: every dict of tensors (e.g. state_dict)
+is stored in the index as '{key}/{name}', every other value as JSON in the metadata.
+'''
+
+EXTENSION = '.safetensors'
+
+_dtypes = {
+    torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+    torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8',
+    torch.uint8: 'U8', torch.bool: 'BOOL',
+}
+_torch_dtypes = {name: dtype for dtype, name in _dtypes.items()}
+# numpy has no bfloat16, these tensors are mapped as int16 and reinterpreted
+_numpy_dtypes = {'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16, 'I64': np.int64,
+                 'I32': np.int32, 'I16': np.int16, 'I8': np.int8, 'U8': np.uint8, 'BOOL': np.bool_}
+
+
+def is_tensor_dict(value):
+    return isinstance(value, dict) and len(value) > 0 and all(torch.is_tensor(v) for v in value.values())
+
+
+def save_file(state, path):
+    """writes a checkpoint dict to path"""
+    tensors = []
+    header = {}
+    metadata = {}
+    offset = 0
+    for key, value in state.items():
+        if is_tensor_dict(value):
+            for name, tensor in value.items():
+                tensor = tensor.detach().cpu().contiguous()
+                size = tensor.numel() * tensor.element_size()
+                header['{}/{}'.format(key, name)] = {'dtype': _dtypes[tensor.dtype], 'shape': list(tensor.shape),
+                                                     'data_offsets': [offset, offset + size]}
+                tensors.append(tensor)
+                offset += size
+        else:
+            try:
+                metadata[key] = json.dumps(value)
+            except TypeError:
+                raise ValueError('cannot store {} ({}) in a {} checkpoint, only dicts of tensors and JSON values '
+                                 'are supported'.format(key, type(value).__name__, EXTENSION))
+    header['__metadata__'] = metadata
+
+    header = json.dumps(header).encode()
+    header += b' ' * (-len(header) % 8)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for tensor in tensors:
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(memoryview(tensor.numpy()).cast('B'))
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode())
+    return header, 8 + size
+
+
+def load_file(path, map_location=None):
+    """reads a checkpoint dict from path. CPU tensors are copy-on-write views of a memory map of the file"""
+    header, data_start = read_header(path)
+    metadata = header.pop('__metadata__', {})
+    state = {key: json.loads(value) for key, value in metadata.items()}
+    if not header:
+        return state
+
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    for name, info in header.items():
+        key, tensor_name = name.split('/', 1)
+        begin, end = info['data_offsets']
+        dtype = _numpy_dtypes[info['dtype']]
+        array = np.frombuffer(buffer, dtype=dtype, count=(end - begin) // np.dtype(dtype).itemsize,
+                              offset=data_start + begin)
+        tensor = torch.from_numpy(array).view(info['shape'])
+        if info['dtype'] == 'BF16':
+            tensor = tensor.view(torch.bfloat16)
+        if map_location is not None:
+            tensor = tensor.to(map_location)
+        state.setdefault(key, {})[tensor_name] = tensor
+    return state
+
+
+def load_checkpoint(path, map_location=None):
+    """loads a .safetensors or a torch (.pth.tar) checkpoint"""
+    if str(path).endswith(EXTENSION):
+        return load_file(path, map_location)
+    return torch.load(path, map_location=map_location)
+
+
+def convert(src, dst):
+    """converts a checkpoint between the torch and the flat format, the format is given by the extensions"""
+    state = load_checkpoint(src, map_location='cpu')
+    if str(dst).endswith(EXTENSION):
+        save_file(state, dst)
+    else:
+        torch.save(state, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert checkpoints between .pth.tar and ' + EXTENSION,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('src', metavar='SRC', help='checkpoint to convert')
+    parser.add_argument('dst', metavar='DST', help='converted checkpoint, the format is given by the extension')
+    args = parser.parse_args()
+    convert(args.src, args.dst)
+    print('=> {} ({:.1f} MB) -> {} ({:.1f} MB)'.format(args.src, os.path.getsize(args.src) / 2**20,
+                                                       args.dst, os.path.getsize(args.dst) / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import threading
+import zlib
+
+from path import Path
+
+
+def parse_shard(shard):
+    """'i/n' -> (i, n), shards are numbered from 0"""
+    try:
+        index, count = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise ValueError('shards should be given as i/n, got {}'.format(shard))
+    if not 0 <= index < count:
+        raise ValueError('shard index should be between 0 and {}, got {}'.format(count - 1, index))
+    return index, count
+
+
+def in_shard(name, shard):
+    """stable assignment of a file name to one of n shards, the same in every process"""
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(name.encode()) % count == index
+
+
+def iter_pairs(data_dir, exts, shard=None, skip=lambda img1_file: False):
+    """Lazily yields [img1, img2, gt] for every '[name]1.[ext]' image of data_dir with a matching
+    '[name]2.[ext]', gt is '[name minus 'img']flow.flo' and may not exist.
+
+    The directory is read once with os.scandir, pairs are yielded as they are found, in directory order.
+    Only pairs of the given (i, n) shard are yielded, and pairs for which skip(img1_file) is True are left out.
+    """
+    exts = set('.' + ext for ext in exts)
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext not in exts or not stem.endswith('1') or not in_shard(entry.name, shard):
+                continue
+            img1_file = Path(entry.path)
+            if skip(img1_file):
+                continue
+            img2_file = img1_file.parent / (stem[:-1] + '2' + ext)
+            if img2_file.isfile():
+                yield [img1_file, img2_file, img1_file.parent / (stem[:-4] + 'flow.flo')]
+
+
+def iter_frames(data_dir, exts):
+    """video frames of data_dir, in file name order"""
+    exts = set('.' + ext for ext in exts)
+    with os.scandir(data_dir) as entries:
+        return sorted(Path(entry.path) for entry in entries if os.path.splitext(entry.name)[1] in exts)
+
+
+class CompletionManifest(object):
+    """Append-only record of the outputs written to a folder, to resume an interrupted run.
+
+    Every process appends the names of its completed outputs, one per line, to its own file
+    (manifest.txt, or manifest_{i}of{n}.txt for shard i/n), so that shards never write to the same file.
+    All manifest files of the folder are read on start, a truncated last line from a crash is ignored.
+    """
+
+    def __init__(self, save_path, shard=None):
+        self.done = set()
+        for manifest in save_path.files('manifest*.txt'):
+            with open(manifest) as f:
+                lines = f.read().split('\n')
+            # the last line is either empty or was not completely written
+            self.done.update(line for line in lines[:-1] if line)
+        name = 'manifest.txt' if shard is None else 'manifest_{}of{}.txt'.format(*shard)
+        self.file = open(save_path / name, 'a')
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def add(self, names):
+        with self.lock:
+            for name in names:
+                self.done.add(name)
+                self.file.write(name + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
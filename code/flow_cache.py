@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+def file_hash(path, chunk_size=2**20):
+    """sha256 hex digest of the content of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pair_hash(*contents):
+    """sha256 hex digest of the raw bytes of the images of a pair, the order matters"""
+    h = hashlib.sha256()
+    for content in contents:
+        h.update(hashlib.sha256(content).digest())
+    return h.hexdigest()
+
+
+class FlowCache(object):
+    """Content addressed on-disk cache of network outputs.
+
+    Entries are keyed by the hash of the checkpoint, the hash of the content of the image pair and the
+    inference options that change the output (exit level, upsampling...), so renamed or copied images
+    still hit and changing the model or the options never returns stale flows. Outputs are stored as .npy
+    files under `root`, the least recently used ones are evicted once the cache exceeds `max_size` MB.
+    A manifest (manifest.json) keeps the size and last access of every entry, as well as the hit and
+    miss counts of all runs. Entries missing from the manifest, e.g. after a crash, are picked up again.
+
+    Lookups and insertions are thread safe, call close() to write the manifest.
+    """
+
+    def __init__(self, root, checkpoint_hash, options, max_size=10240):
+        self.root = root
+        self.max_size = max_size * 2**20
+        self.prefix = hashlib.sha256(json.dumps([checkpoint_hash, options], sort_keys=True).encode()).digest()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.manifest = {'entries': {}, 'hits': 0, 'misses': 0, 'evictions': 0}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        self.entries = self._scan(self.manifest['entries'])
+        self.size = sum(entry['size'] for entry in self.entries.values())
+
+    def _scan(self, known):
+        entries = {}
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                key, ext = os.path.splitext(entry.name)
+                if ext != '.npy':
+                    continue
+                stat = entry.stat()
+                entries[key] = known.get(key, {'size': stat.st_size, 'atime': stat.st_mtime})
+        return entries
+
+    def key(self, pair_hash):
+        return hashlib.sha256(self.prefix + pair_hash.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def get(self, key):
+        """cached output for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry['atime'] = time.time()
+        try:
+            output = np.load(self._path(key))
+        except (IOError, ValueError, EOFError):  # evicted or removed meanwhile, or truncated
+            output = None
+        # only counted once loaded, an entry that can't be read is recomputed like a miss
+        with self.lock:
+            if output is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return output
+
+    def put(self, key, output):
+        """stores a numpy output, then evicts the least recently used entries if needed"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, output)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries[key]['size']
+            self.entries[key] = {'size': size, 'atime': time.time()}
+            self.size += size
+            evicted = []
+            if self.size > self.max_size:
+                for old_key in sorted(self.entries, key=lambda k: self.entries[k]['atime']):
+                    if self.size <= self.max_size:
+                        break
+                    if old_key == key:
+                        continue
+                    self.size -= self.entries.pop(old_key)['size']
+                    evicted.append(old_key)
+            self.evictions += len(evicted)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / max(lookups, 1), 'entries': len(self.entries),
+                'size_mb': self.size / 2**20}
+
+    def close(self):
+        """writes the manifest, with the counts of this run added to the totals"""
+        with self.lock:
+            manifest = {'entries': self.entries,
+                        'hits': self.manifest['hits'] + self.hits,
+                        'misses': self.manifest['misses'] + self.misses,
+                        'evictions': self.manifest['evictions'] + self.evictions}
+            lookups = manifest['hits'] + manifest['misses']
+            manifest['hit_rate'] = manifest['hits'] / max(lookups, 1)
+            tmp_path = self.manifest_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,165 @@
+import os
+import threading
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError as e:
+    import warnings
+    with warnings.catch_warnings():
+        warnings.filterwarnings("default", category=ImportWarning)
+        warnings.warn("failed to load openCV, which is needed"
+                      "to write KITTI 16bit PNG flow maps", ImportWarning)
+
+'''
+Writers for batches of flow maps. All encoders take B x H x W x 2 arrays in pixels (as in .flo files)
+and convert the whole batch at once, only the final file writes are done per flow map.
+'''
+
+FLO_MAGIC = 202021.25
+
+
+def encode_flo(flows):
+    """B x H x W x 2 flows -> list of .flo file contents (magic, width, height, row major float32 data)"""
+    flows = np.ascontiguousarray(flows, dtype=np.float32)
+    _, h, w, _ = flows.shape
+    header = np.array([FLO_MAGIC], np.float32).tobytes() + np.array([w, h], np.int32).tobytes()
+    return [header + flow.tobytes() for flow in flows]
+
+
+def encode_kitti(flows, valid=None):
+    """B x H x W x 2 flows -> B x H x W x 3 uint16 (u, v, valid) images as in the KITTI devkit,
+    i.e. value = flow * 64 + 2^15. The channels are in RGB order"""
+    encoded = np.empty(flows.shape[:3] + (3,), np.uint16)
+    encoded[..., :2] = np.clip(np.rint(flows * 64. + 2**15), 0, 2**16 - 1)
+    encoded[..., 2] = 1 if valid is None else valid
+    return encoded
+
+
+def decode_kitti(encoded):
+    """inverse of encode_kitti, returns the H x W x 2 flow and the H x W valid mask"""
+    flow = (encoded[..., :2].astype(np.float32) - 2**15) / 64.
+    return flow, encoded[..., 2] > 0
+
+
+class FlowWriter(object):
+    """Writes every flow map of a batch to its own file, `filenames` are given without extension.
+
+    write() and close() return the names (without folder and extension) of the flow maps that are on disk
+    once they return, writers that buffer flow maps report them when they are actually written.
+    """
+    extension = None
+
+    def encode(self, flows):
+        raise NotImplementedError
+
+    def write_file(self, filename, encoded):
+        raise NotImplementedError
+
+    def write(self, filenames, flows):
+        for filename, encoded in zip(filenames, self.encode(flows)):
+            self.write_file(filename + self.extension, encoded)
+        return [filename.basename() for filename in filenames]
+
+    def close(self):
+        return []
+
+
+class NpyWriter(FlowWriter):
+    extension = '.npy'
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+
+    def encode(self, flows):
+        return np.asarray(flows, dtype=self.dtype)
+
+    def write_file(self, filename, encoded):
+        np.save(filename, encoded)
+
+
+class FloWriter(FlowWriter):
+    extension = '.flo'
+
+    def encode(self, flows):
+        return encode_flo(flows)
+
+    def write_file(self, filename, encoded):
+        with open(filename, 'wb') as f:
+            f.write(encoded)
+
+
+class KittiWriter(FlowWriter):
+    # not .png, which is taken by the color visualization
+    extension = '_kitti.png'
+
+    def encode(self, flows):
+        # OpenCV expects BGR
+        return encode_kitti(flows)[..., ::-1]
+
+    def write_file(self, filename, encoded):
+        cv2.imwrite(filename, np.ascontiguousarray(encoded))
+
+
+class ArchiveWriter(FlowWriter):
+    """Gathers flow maps into compressed .npz archives of `chunk_size` flows each, keyed by file name.
+
+    Archives are named flows_00000.npz, flows_00001.npz... in `save_path`, numbering continues after
+    existing archives. Each archive file is created exclusively before it is written, so that several
+    processes (e.g. --shard workers) writing to the same folder take the next free index instead of
+    overwriting each other. Writes from several threads are safe, call close() to write the last chunk.
+    """
+    extension = '.npz'
+
+    def __init__(self, save_path, chunk_size=64, dtype=np.float16):
+        self.save_path = save_path
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.chunk = {}
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def write(self, filenames, flows):
+        flows = np.asarray(flows, dtype=self.dtype)
+        chunks = []
+        with self.lock:
+            for filename, flow in zip(filenames, flows):
+                self.chunk[filename.basename()] = flow
+                if len(self.chunk) == self.chunk_size:
+                    chunks.append(self._pop())
+        for filename, chunk in chunks:
+            np.savez_compressed(filename, **chunk)
+        return [name for _, chunk in chunks for name in chunk]
+
+    def _pop(self):
+        while True:
+            filename = self.save_path/'flows_{:05d}{}'.format(self.index, self.extension)
+            self.index += 1
+            try:
+                os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                continue
+        chunk, self.chunk = self.chunk, {}
+        return filename, chunk
+
+    def close(self):
+        with self.lock:
+            if not self.chunk:
+                return []
+            filename, chunk = self._pop()
+        np.savez_compressed(filename, **chunk)
+        return list(chunk)
+
+
+def flow_writer(output_format, save_path, dtype=np.float32, chunk_size=64):
+    if output_format == 'npy':
+        return NpyWriter(dtype)
+    if output_format == 'flo':
+        return FloWriter()
+    if output_format == 'kitti':
+        return KittiWriter()
+    if output_format == 'archive':
+        return ArchiveWriter(save_path, chunk_size, dtype)
+    raise ValueError('unknown output format {}'.format(output_format))
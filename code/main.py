@@ -1,27 +1,31 @@
 import argparse
+import contextlib
 import os
+import random
 import time
 
+import numpy as np
+
 import torch
 import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim
 import torch.utils.data
-import torchvision.transforms as transforms
 import flow_transforms
 import models
 import datasets
+from models.util import has_batch_norm
 from multiscaleloss import multiscaleEPE, realEPE
 from own_loss import *
 import datetime
-from tensorboardX import SummaryWriter
-import wandb
-from util import flow2rgb, AverageMeter, save_checkpoint, save_image
+from util import flow_to_color, AverageMeter, CheckpointWriter, ResumableSampler, SeededDataset, save_image
+from util import get_rng_state, set_rng_state, setup_for_distributed, NullWriter, CompiledStep
+from checkpoint import load_checkpoint
+from precision import PRECISIONS, autocast
 
 
-model_names = sorted(name for name in models.__dict__
-                     if name.islower() and not name.startswith("__"))
+model_names = models.model_names
 dataset_names = sorted(name for name in datasets.__all__)
 
 parser = argparse.ArgumentParser(description='PyTorch FlowNet Training on several datasets',
@@ -46,12 +50,15 @@ parser.add_argument('--solver', default='adam',choices=['adam','sgd'],
                     help='solver algorithms')
 parser.add_argument('-j', '--workers', default=8, type=int, metavar='N',
                     help='number of data loading workers')
-# parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
-#                     help='manual epoch number (useful on restarts)')
+parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
+                    help='manual epoch number (useful on restarts)')
 parser.add_argument('--epoch-size', default=1000, type=int, metavar='N',
                     help='manual epoch size (will match dataset size if set to 0)')
 parser.add_argument('-b', '--batch-size', default=8, type=int,
                     metavar='N', help='mini-batch size')
+parser.add_argument('--accumulate', default=1, type=int, metavar='N',
+                    help='number of mini-batches whose gradients are accumulated before each optimizer step, the effective'
+                    ' batch size is N x --batch-size (x the number of processes)')
 parser.add_argument('--lr', '--learning-rate', default=0.0001, type=float,
                     metavar='LR', help='initial learning rate')
 parser.add_argument('--momentum', default=0.9, type=float, metavar='M',
@@ -74,21 +81,64 @@ parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
 parser.add_argument('--pretrained', dest='pretrained', default=None,
                     help='path to pre-trained model')
+parser.add_argument('--checkpoint-format', choices=['pth', 'safetensors'], default='pth',
+                    help='format of the saved checkpoints, safetensors files are memory mapped when loaded')
+parser.add_argument('--resume', default=None, metavar='PATH',
+                    help='continue an interrupted training from its snapshot.pth.tar, in the middle of an epoch if needed.'
+                    ' Model, optimizer, scheduler, random generators and data order are restored')
+parser.add_argument('--snapshot-interval', default=500, type=int, metavar='N',
+                    help='save the training state to snapshot.pth.tar every N iterations, in addition to the end of every'
+                    ' epoch. 0 to only save it at the end of epochs')
+parser.add_argument('--seed', default=None, type=int,
+                    help='seed of the train/test split, the initialization and the data order. Random if not set')
+parser.add_argument('--keep-checkpoints', default=3, type=int, metavar='K',
+                    help='number of latest epoch checkpoints to keep, in addition to the best one')
 parser.add_argument('--no-date', action='store_true',
                     help='don\'t append date timestamp to folder' )
 parser.add_argument('--div-flow', default=20, help='value by which flow will be divided. Original value is 20 but 1 with batchNorm gives good results')
+parser.add_argument('--epochs', default=None, type=int, metavar='N',
+                    help='number of epochs to train, overrides the epochs of the configuration')
 parser.add_argument('--milestones', default=[100,150,200], metavar='N', nargs='*', help='epochs at which learning rate is divided by 2')
 parser.add_argument('--self-supervised-loss', default=True, help='use self-supervised loss (photometric and smoothness)')
 parser.add_argument('--device', type=str, default=None)
 parser.add_argument('--unflow', default=True, help='use of ternary and second order losses from Unflow paper)')
+parser.add_argument('--search-range', default=[4], type=int, nargs='+', metavar='R',
+                    help='pwcnet only: cost volume search radius, one value or one per level from level 2 to level 6')
+parser.add_argument('--search-stride', default=[1], type=int, nargs='+', metavar='S',
+                    help='pwcnet only: cost volume displacement stride, one value or one per level from level 2 to level 6')
+parser.add_argument('--checkpoint-activations', action='store_true',
+                    help='save memory by recomputing the activations of every encoder stage (flownets, flownetc) or decoder'
+                    ' and refiner (pwcnet) during backward, at the cost of a slower step. Stages with batch norm are'
+                    ' not recomputed')
+parser.add_argument('--precision', choices=PRECISIONS, default='float32',
+                    help='bfloat16 runs the models and losses under autocast, the sampling grids, charbonnier powers, SSIM'
+                    ' variances and EPE stay in float32')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the model and the enabled loss terms of the training step with torch.compile, falls back to'
+                    ' eager mode if compilation fails')
+parser.add_argument('--dist-backend', default=None, choices=['gloo', 'nccl'],
+                    help='backend of distributed training, nccl on GPUs and gloo on CPUs if not set')
+parser.add_argument('--bucket-cap-mb', default=25, type=float, metavar='MB',
+                    help='distributed training: size of the gradient buckets that are all-reduced together during backward')
 
 args = parser.parse_args()
 
+# the arguments that define a training run, a resumed run continues with those of its snapshot
+TRAINING_ARGS = ['dataset', 'split_file', 'split_value', 'solver', 'epoch_size', 'batch_size', 'accumulate', 'lr',
+                 'momentum', 'beta', 'weight_decay', 'bias_decay', 'multiscale_weights', 'sparse', 'div_flow',
+                 'milestones', 'search_range', 'search_stride', 'precision']
+
 best_EPE = -1
 n_iter = 0
 
+# set by torchrun, e.g. torchrun --nproc_per_node 4 main.py ... trains with 4 processes of --batch-size each
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+distributed = world_size > 1
+
 if args.device is None:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda:{}".format(local_rank) if torch.cuda.is_available() else "cpu")
 else:
     device = torch.device(args.device)
 
@@ -120,11 +170,56 @@ def get_default_config():
 
 
 def main(config=get_default_config()):
-    global best_EPE
-
-    wandb.init(project="fr-optical-flow", sync_tensorboard=True)
-    wandb.config.update(args) # log configs passed in from progrom arguments
-    wandb.config.update(config) # log also configs coming from BOHB interface
+    global best_EPE, n_iter
+
+    if args.epochs is not None:
+        config["epochs"] = args.epochs
+
+    # imported here rather than at the top, they are slow to import and not needed to parse arguments
+    import torchvision.transforms as transforms
+    import wandb
+    from tensorboardX import SummaryWriter
+
+    if distributed:
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        torch.distributed.init_process_group(backend=args.dist_backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+        # only the first process prints, logs and saves checkpoints
+        setup_for_distributed(rank == 0)
+        print('=> distributed training with {} processes, backend {}'.format(world_size, torch.distributed.get_backend()))
+
+    resume_state = None
+    if args.resume:
+        # the snapshot holds the python and numpy random states, not only tensors, and is a file of our own
+        resume_state = torch.load(args.resume, map_location='cpu', weights_only=False)
+        args.arch = resume_state['arch']
+        args.seed = resume_state['seed']
+        if 'args' not in resume_state:
+            print('=> warning: {} does not hold its training arguments, using those of the command line'
+                  .format(args.resume))
+        for name, value in resume_state.get('args', {}).items():
+            # only arguments left to their default can be taken from the snapshot
+            if getattr(args, name) not in [parser.get_default(name), value]:
+                parser.error('--{} {} differs from the value {} of {}'
+                             .format(name.replace('_', '-'), getattr(args, name), value, args.resume))
+            setattr(args, name, value)
+        print("=> resuming '{}' from epoch {}, batch {}".format(args.resume, resume_state['epoch'], resume_state['batch']))
+    if args.seed is None:
+        args.seed = random.randrange(2**31)
+        if distributed:
+            # all processes need the same split and initialization
+            seed = [args.seed]
+            torch.distributed.broadcast_object_list(seed, src=0)
+            args.seed = seed[0]
+    # the train/test split is random too, so it has to be seeded for a resumed run to see the same samples
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    if rank == 0:
+        wandb.init(project="fr-optical-flow", sync_tensorboard=True)
+        wandb.config.update(args) # log configs passed in from progrom arguments
+        wandb.config.update(config) # log also configs coming from BOHB interface
 
     save_path = '{},{},{},b{},lr{}'.format(
         args.arch,
@@ -136,15 +231,21 @@ def main(config=get_default_config()):
         timestamp = datetime.datetime.now().strftime("%m-%d-%H:%M")
         save_path = os.path.join(timestamp,save_path)
     save_path = os.path.join(args.dataset,save_path)
+    if args.resume:
+        save_path = os.path.dirname(args.resume)
     print('=> will save everything to {}'.format(save_path))
-    if not os.path.exists(save_path):
+    if rank == 0 and not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    train_writer = SummaryWriter(os.path.join(save_path,'train'))
-    test_writer = SummaryWriter(os.path.join(save_path,'test'))
-    output_writers = []
-    for i in range(3):
-        output_writers.append(SummaryWriter(os.path.join(save_path,'test',str(i))))
+    if rank == 0:
+        train_writer = SummaryWriter(os.path.join(save_path,'train'))
+        test_writer = SummaryWriter(os.path.join(save_path,'test'))
+        output_writers = []
+        for i in range(3):
+            output_writers.append(SummaryWriter(os.path.join(save_path,'test',str(i))))
+    else:
+        train_writer = test_writer = NullWriter()
+        output_writers = []
 
     # Data loading code
     input_transform = transforms.Compose([
@@ -193,30 +294,48 @@ def main(config=get_default_config()):
     print('{} samples found, {} train samples and {} test samples '.format(len(test_set)+len(train_set),
                                                                            len(train_set),
                                                                            len(test_set)))
+    # the sampler gives the data order and the augmentation seeds, so that an epoch can be resumed exactly
+    train_sampler = ResumableSampler(train_set, seed=args.seed, num_replicas=world_size, rank=rank)
     train_loader = torch.utils.data.DataLoader(
-        train_set, batch_size=args.batch_size,
-        num_workers=args.workers, pin_memory=True, shuffle=True)
+        SeededDataset(train_set), batch_size=args.batch_size, sampler=train_sampler,
+        num_workers=args.workers, pin_memory=True)
     val_loader = torch.utils.data.DataLoader(
         test_set, batch_size=args.batch_size,
         num_workers=args.workers, pin_memory=True, shuffle=False)
 
     # create model
-    if args.pretrained:
-        network_data = torch.load(args.pretrained)
+    if resume_state is not None:
+        network_data = resume_state
+    elif args.pretrained:
+        network_data = load_checkpoint(args.pretrained, map_location=device)
         args.arch = network_data['arch']
         print("=> using pre-trained model '{}'".format(args.arch))
     else:
         network_data = None
         print("=> creating model '{}'".format(args.arch))
 
-    model = models.__dict__[args.arch](network_data).to(device)
-    # model = torch.nn.DataParallel(model).cuda()
+    if args.arch == 'pwcnet':
+        model = models.get(args.arch)(network_data,
+                                      search_range=args.search_range,
+                                      search_stride=args.search_stride).to(device)
+    else:
+        model = models.get(args.arch)(network_data).to(device)
+    # the network itself, for its parameter groups and checkpoints, model is wrapped when distributed
+    net = model
+    net.checkpoint_activations = args.checkpoint_activations
+    if args.checkpoint_activations and has_batch_norm(net):
+        print('=> {} has batch norm, its stages keep their activations'.format(args.arch))
+    if distributed:
+        # gradients are all-reduced in buckets of --bucket-cap-mb while backward is still running
+        model = torch.nn.parallel.DistributedDataParallel(
+            net, device_ids=[device] if device.type == 'cuda' else None,
+            bucket_cap_mb=args.bucket_cap_mb, gradient_as_bucket_view=True)
     cudnn.benchmark = True
 
     assert(args.solver in ['adam', 'sgd'])
     print('=> setting {} solver'.format(args.solver))
-    param_groups = [{'params': model.bias_parameters(), 'weight_decay': args.bias_decay},
-                    {'params': model.weight_parameters(), 'weight_decay': args.weight_decay}]
+    param_groups = [{'params': net.bias_parameters(), 'weight_decay': args.bias_decay},
+                    {'params': net.weight_parameters(), 'weight_decay': args.weight_decay}]
     if args.solver == 'adam':
         optimizer = torch.optim.Adam(param_groups, args.lr,
                                      betas=(args.momentum, args.beta))
@@ -225,24 +344,89 @@ def main(config=get_default_config()):
                                     momentum=args.momentum)
 
     if args.evaluate:
-        best_EPE = validate(val_loader, model, 0, output_writers)
+        if rank == 0:
+            best_EPE = validate(val_loader, net, 0, output_writers)
         return
 
     scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.milestones, gamma=0.5)
-    wandb.watch(model, log='all')
+    checkpoint_writer = None
+    if rank == 0:
+        wandb.watch(net, log='all')
+        # checkpoints are written in the background, the training loop only waits for the copy to CPU memory
+        checkpoint_writer = CheckpointWriter(save_path, keep=args.keep_checkpoints,
+                                             extension='.pth.tar' if args.checkpoint_format == 'pth' else '.safetensors')
+
+    def training_state(epoch, batch, meters):
+        state = {
+            'epoch': epoch,
+            'batch': batch,
+            # samples of the epoch already seen by each process
+            'samples': batch * args.batch_size,
+            'meters': meters,
+            'n_iter': n_iter,
+            'seed': args.seed,
+            'world_size': world_size,
+            'arch': args.arch,
+            'state_dict': net.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'best_EPE': best_EPE,
+            'div_flow': args.div_flow,
+            'rng': get_rng_state(),
+            'args': {name: getattr(args, name) for name in TRAINING_ARGS}
+        }
+        if args.arch == 'pwcnet':
+            state['search_range'] = net.search_range
+            state['search_stride'] = net.search_stride
+        return state
+
+    def snapshot(epoch, batch, meters):
+        if checkpoint_writer is not None:
+            checkpoint_writer.save_training_state(training_state(epoch, batch, meters))
+
+    # one graph per configuration of the loss terms, compiled on the first batch
+    compute_loss = loss_function()
+    if args.compile:
+        compute_loss = CompiledStep(compute_loss)
+
+    start_batch, start_samples, meters = 0, 0, None
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        args.start_epoch = resume_state['epoch']
+        if resume_state.get('world_size', 1) != world_size:
+            print('=> warning: {} was saved with {} processes, the data order of the rest of the epoch will differ'
+                  .format(args.resume, resume_state.get('world_size', 1)))
+        # the meters of the snapshot are the totals of all processes, they are restored in the first one only
+        start_batch = resume_state['batch']
+        start_samples = resume_state.get('samples', start_batch * args.batch_size)
+        meters = resume_state['meters'] if rank == 0 else None
+        n_iter = resume_state['n_iter']
+        best_EPE = resume_state['best_EPE']
+        set_rng_state(resume_state['rng'])
+    else:
+        for _ in range(args.start_epoch):
+            scheduler.step()
 
-    #for epoch in range(args.start_epoch, args.epochs):
-    for epoch in range(int(config["epochs"])):
+    for epoch in range(args.start_epoch, int(config["epochs"])):
 
         # train for one epoch
-        train_loss, train_EPE = train(train_loader, model, optimizer, epoch, train_writer, config)
+        train_sampler.set_epoch(epoch, start_samples)
+        train_loss, train_EPE = train(train_loader, model, optimizer, epoch, train_writer, config,
+                                      start=start_batch, meters=meters, snapshot=snapshot, compute_loss=compute_loss)
+        start_batch, start_samples, meters = 0, 0, None
         scheduler.step()
         train_writer.add_scalar('mean EPE', train_EPE, epoch)
 
-        # evaluate on validation set
+        # evaluate on validation set, in the first process only
 
-        with torch.no_grad():
-            EPE = validate(val_loader, model, epoch, output_writers)
+        if rank == 0:
+            with torch.no_grad():
+                EPE = validate(val_loader, net, epoch, output_writers)
+        if distributed:
+            EPE = [EPE if rank == 0 else None]
+            torch.distributed.broadcast_object_list(EPE, src=0)
+            EPE = EPE[0]
         test_writer.add_scalar('mean EPE', EPE, epoch)
 
         if best_EPE < 0:
@@ -250,258 +434,285 @@ def main(config=get_default_config()):
 
         is_best = EPE < best_EPE
         best_EPE = min(EPE, best_EPE)
-        save_checkpoint({
+        state = {
             'epoch': epoch + 1,
             'arch': args.arch,
-            'state_dict': model.state_dict(),
+            'state_dict': net.state_dict(),
             'best_EPE': best_EPE,
             'div_flow': args.div_flow
-        }, is_best, save_path)
-
+        }
+        if args.arch == 'pwcnet':
+            state['search_range'] = net.search_range
+            state['search_stride'] = net.search_stride
+        if checkpoint_writer is not None:
+            checkpoint_writer.save(state, is_best, epoch + 1)
+        snapshot(epoch + 1, 0, None)
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
     return best_EPE
 
 
-def train(train_loader, model, optimizer, epoch, train_writer, config):
+def supervised_loss(model, input, target, config):
+    # use old loss
+    input = torch.cat(input,1)
+
+    # compute output
+    output = model(input)
+    if args.sparse:
+        # Since Target pooling is not very precise when sparse,
+        # take the highest resolution prediction and upsample it instead of downsampling target
+        h, w = target.size()[-2:]
+        output = [F.interpolate(output[0], (h,w)), *output[1:]]
+
+    loss = multiscaleEPE(output, target, weights=args.multiscale_weights, sparse=args.sparse)
+    flow2_EPE = args.div_flow * realEPE(output[0], target, sparse=args.sparse)
+    return loss, flow2_EPE, {}
+
+
+def unflow_loss(model, input, target, config):
+    im1, im2 = input
+    input_fw = torch.cat(input, 1)
+    pred_fw = model(input_fw)
+    input_bw = torch.cat((im2, im1), 1)
+    pred_bw = model(input_bw)
+    terms = {}
+
+    census_loss = 0
+    if config['census']:
+        #weights = [1, 0.34, 0.31, 0.27, 0.09]
+        #max_dist = [3, 2, 2, 1, 1]
+        terms['census'] = []
+        for i in range(len(pred_fw)):
+            flow_fw = pred_fw[i] * args.div_flow
+            flow_bw = pred_bw[i] * args.div_flow
+            loss = ternary_loss(im2, im1,  flow_fw, max_distance=1) +\
+                ternary_loss(im1, im2, flow_bw,max_distance=1)
+            census_loss += loss
+            terms['census'].append(loss)
+            if not config['multiscale_census_loss']:
+                break
+
+    sl_loss = 0
+    if config['sl']:
+        terms['sl'] = []
+        for i in range(len(pred_fw)):
+            flow_fw = pred_fw[i] * args.div_flow
+            flow_bw = pred_bw[i] * args.div_flow
+            loss = smoothness_loss(flow_fw,config) + smoothness_loss(flow_bw,config)
+            #loss = smoothness_loss(flow_bw, config)
+            sl_loss += loss
+            terms['sl'].append(loss)
+            if not config['multiscale_sl_loss']:
+                break
+
+    ssim_loss = 0
+    if config['ssim']:
+        terms['ssim'] = []
+        for i in range(len(pred_bw)):
+            flow_bw = pred_bw[i] * args.div_flow
+            loss = ssim(im1,im2,flow_bw)
+            ssim_loss += loss
+            terms['ssim'].append(loss)
+            if not config['multiscale_ssim_loss']:
+                break
+
+    fb_loss = 0
+    if config['fb']:
+        terms['fb'] = []
+        for i in range(len(pred_bw)):
+            flow_fw = pred_fw[i] * args.div_flow
+            flow_bw = pred_bw[i] * args.div_flow
+            loss = forward_backward_loss(im1=im1, im2=im2, flow_fw=flow_fw, flow_bw=flow_bw, config=config)
+            fb_loss += loss
+            terms['fb'].append(loss)
+            if not config['multiscale_fb_loss']:
+                break
+
+    loss = census_loss + sl_loss + ssim_loss + 0.001*fb_loss
+
+    flow = pred_bw[0]
+    flow2_EPE = args.div_flow * realEPE(flow, target, sparse=args.sparse)
+    return loss, flow2_EPE, terms
+
+
+def self_supervised_loss(model, input, target, config):
+    # use self-supervised loss
+    im1, im2 = input
+    input = torch.cat(input,1)
+    pred = model(input)
+    terms = {'pl': [], 'sl': []}
+
+    pl_loss = 0
+    for i in range(len(pred)):
+        flow = pred[i] * args.div_flow
+        loss = photometric_loss(im1, im2, flow, config)
+        pl_loss += loss
+        terms['pl'].append(loss)
+
+        if not config['multiscale_pl_loss']:
+            break
+
+    sl_loss = 0
+    if config['weighted_sl_loss']:
+        for i in range(len(pred)):
+            flow = pred[i] * args.div_flow
+            loss = weighted_smoothness_loss(im1, im2, flow, config)
+            sl_loss += loss
+            terms['sl'].append(loss)
+
+            if not config['multiscale_sl_loss']:
+                break
+
+    else:
+        # smoothness loss for multi resolution flow pyramid
+        for i in range(len(pred)):
+            flow = pred[i] * args.div_flow
+            loss = smoothness_loss(flow, config)
+            sl_loss += loss
+            terms['sl'].append(loss)
+
+            if not config['multiscale_sl_loss']:
+                break
+
+    loss = pl_loss + sl_loss
+
+    flow = pred[0]
+    flow2_EPE = args.div_flow * realEPE(flow, target, sparse=args.sparse)
+    return loss, flow2_EPE, terms
+
+
+def loss_function():
+    """loss of the training step: model, [im1, im2], target, config -> loss, EPE, {term: [loss per scale]}.
+    The step is free of host synchronizations and logging, so that it can be compiled as a whole"""
+    if not args.self_supervised_loss:
+        return supervised_loss
+    elif args.unflow:
+        return unflow_loss
+    else:
+        return self_supervised_loss
+
+
+def accumulate_terms(step_terms, terms, step_batches):
+    """adds the per scale loss terms of a batch to those of its optimizer step, which get their mean over the batches"""
+    for name, values in terms.items():
+        values = [value.item() / step_batches for value in values]
+        step_terms[name] = [a + b for a, b in zip(step_terms[name], values)] if name in step_terms else values
+
+
+def log_terms(step_terms, train_writer):
+    for name, values in step_terms.items():
+        train_writer.add_scalar('train_loss_' + name, sum(values), n_iter)
+    # to check the magnitude of the losses
+    if n_iter % 500 == 0:
+        for name, values in step_terms.items():
+            print("[DEBUG] {}_loss:".format(name), str(values))
+
+
+def train(train_loader, model, optimizer, epoch, train_writer, config, start=0, meters=None, snapshot=None,
+          compute_loss=None):
+    """trains for one epoch, from batch `start` with the epoch meters `meters` when resuming.
+    The gradients of --accumulate consecutive batches are summed before every optimizer step, each batch loss
+    being divided by the number of batches of its step so that the step sees their mean. n_iter counts the
+    optimizer steps, snapshot(epoch, batches done, meters) is called every --snapshot-interval steps.
+    compute_loss defaults to loss_function()"""
     global n_iter
 
     batch_time = AverageMeter()
     data_time = AverageMeter()
+    # forward and backward only, without data loading, for the throughput of the compiled step
+    compute_time = AverageMeter()
     losses = AverageMeter()
     flow2_EPEs = AverageMeter()
+    if meters is not None:
+        losses.__dict__.update(meters['losses'])
+        flow2_EPEs.__dict__.update(meters['flow2_EPEs'])
 
-    epoch_size = len(train_loader) if args.epoch_size == 0 else min(len(train_loader), args.epoch_size)
+    # the loader only covers the rest of the epoch when resuming
+    batches = start + len(train_loader)
+    epoch_size = batches if args.epoch_size == 0 else min(batches, args.epoch_size)
+    last = min(batches - 1, epoch_size)
+
+    if compute_loss is None:
+        compute_loss = loss_function()
 
     # switch to train mode
     model.train()
+    optimizer.zero_grad()
+    step_loss = 0
+    step_terms = {}
 
     end = time.time()
 
-    if not args.self_supervised_loss:
-        # use old loss
-        for i, (input, target) in enumerate(train_loader):
-            # measure data loading time
-            data_time.update(time.time() - end)
-            target = target.to(device)
-            input = torch.cat(input,1).to(device)
-
-            # compute output
-            output = model(input)
-            if args.sparse:
-                # Since Target pooling is not very precise when sparse,
-                # take the highest resolution prediction and upsample it instead of downsampling target
-                h, w = target.size()[-2:]
-                output = [F.interpolate(output[0], (h,w)), *output[1:]]
-
-            loss = multiscaleEPE(output, target, weights=args.multiscale_weights, sparse=args.sparse)
-            flow2_EPE = args.div_flow * realEPE(output[0], target, sparse=args.sparse)
-            # record loss and EPE
-            losses.update(loss.item(), target.size(0))
-            train_writer.add_scalar('train_loss', loss.item(), n_iter)
-            flow2_EPEs.update(flow2_EPE.item(), target.size(0))
-
-            # compute gradient and do optimization step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if i % args.print_freq == 0:
-                print('Epoch: [{0}][{1}/{2}]\t Time {3}\t Data {4}\t Loss {5}\t EPE {6}'
-                      .format(epoch, i, epoch_size, batch_time,
-                              data_time, losses, flow2_EPEs))
-            n_iter += 1
-            if i >= epoch_size:
-                break
+    for it, (input, target) in enumerate(train_loader, start):
+        # measure data loading time
+        data_time.update(time.time() - end)
+        compute_start = time.time()
 
-        return losses.avg, flow2_EPEs.avg
-    elif args.unflow:
-        weights = [0.005, 0.01, 0.02, 0.08, 0.32]
+        # steps start every --accumulate batches of the epoch, the last one may be shorter
+        step_start = it - it % args.accumulate
+        step_batches = min(args.accumulate, last + 1 - step_start)
+        optimizer_step = it == step_start + step_batches - 1
 
-        for it, (input, target) in enumerate(train_loader):
-            # measure data loading time
-            data_time.update(time.time() - end)
+        # gradients are only all-reduced between processes on the last batch of a step
+        no_sync = getattr(model, 'no_sync', None)
+        with contextlib.nullcontext() if optimizer_step or no_sync is None else no_sync():
+            input = [im.to(device) for im in input]
             target = target.to(device)
-            im1 = input[0].to(device)
-            im2 = input[1].to(device)
-            input_fw = torch.cat(input, 1).to(device)
-            pred_fw = model(input_fw)
-            input_bw = torch.cat((im2, im1), 1).to(device)
-            pred_bw = model(input_bw)
-
-
-
-            census_loss = 0
-            census_loss_list = []
-            if config['census']:
-                #weights = [1, 0.34, 0.31, 0.27, 0.09]
-                #max_dist = [3, 2, 2, 1, 1]
-                for i in range(len(pred_fw)):
-                    flow_fw = pred_fw[i] * args.div_flow
-                    flow_bw = pred_bw[i] * args.div_flow
-                    loss = ternary_loss(im2, im1,  flow_fw, max_distance=1) +\
-                        ternary_loss(im1, im2, flow_bw,max_distance=1)
-                    census_loss += loss
-                    census_loss_list.append(loss.item())
-                    if not config['multiscale_census_loss']:
-                        break
-                train_writer.add_scalar('train_loss_census', census_loss.item(), n_iter)
-
-            sl_loss = 0
-            sl_loss_list = []
-            if config['sl']:
-                for i in range(len(pred_fw)):
-                    flow_fw = pred_fw[i] * args.div_flow
-                    flow_bw = pred_bw[i] * args.div_flow
-                    loss = smoothness_loss(flow_fw,config) + smoothness_loss(flow_bw,config)
-                    #loss = smoothness_loss(flow_bw, config)
-                    sl_loss += loss
-                    sl_loss_list.append(loss.item())
-                    if not config['multiscale_sl_loss']:
-                        break
-                train_writer.add_scalar('train_loss_sl', sl_loss.item(), n_iter)
-
-            ssim_loss = 0
-            ssim_loss_list = []
-            if config['ssim']:
-                for i in range(len(pred_bw)):
-                    flow_bw = pred_bw[i] * args.div_flow
-                    loss = ssim(im1,im2,flow_bw)
-                    ssim_loss += loss
-                    ssim_loss_list.append(loss.item())
-                    if not config['multiscale_ssim_loss']:
-                        break
-                train_writer.add_scalar('train_loss_ssim', ssim_loss.item(), n_iter)
-
-            fb_loss = 0
-            fb_loss_list = []
-            if config['fb']:
-                for i in range(len(pred_bw)):
-                    flow_fw = pred_fw[i] * args.div_flow
-                    flow_bw = pred_bw[i] * args.div_flow
-                    loss = forward_backward_loss(im1=im1, im2=im2, flow_fw=flow_fw, flow_bw=flow_bw, config=config)
-                    fb_loss += loss
-                    fb_loss_list.append(loss.item())
-                    if not config['multiscale_fb_loss']:
-                        break
-                train_writer.add_scalar('train_loss_fb', fb_loss.item(), n_iter)
-
-            # to check the magnitude of both losses
-            if it % 500 == 0:
-                print("[DEBUG] census_loss:", str(census_loss_list))
-                print("[DEBUG] sl_loss:", str(sl_loss_list))
-                print("[DEBUG] ssim_loss:", str(ssim_loss_list))
-                print("[DEBUG] fb_loss:", str(fb_loss_list))
-
-            loss = census_loss + sl_loss + ssim_loss + 0.001*fb_loss
-
-            # record loss and EPE
-            flow = pred_bw[0]
-            losses.update(loss.item(), target.size(0))
-            flow2_EPE = args.div_flow * realEPE(flow, target, sparse=args.sparse)
-            train_writer.add_scalar('train_loss', loss.item(), n_iter)
-            flow2_EPEs.update(flow2_EPE.item(), target.size(0))
-
-            # compute gradient and do optimization step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            with autocast(device, args.precision):
+                loss, flow2_EPE, terms = compute_loss(model, input, target, config)
+            # compute gradient
+            (loss / step_batches).backward()
+
+        # record loss and EPE
+        accumulate_terms(step_terms, terms, step_batches)
+        losses.update(loss.item(), target.size(0))
+        flow2_EPEs.update(flow2_EPE.item(), target.size(0))
+        step_loss += loss.item() / step_batches
 
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
+        # measure elapsed time, .item() waited for the backward pass
+        if getattr(compute_loss, 'calls', None) == 1:
+            print('=> compiled step: warm-up {:.1f}s for the first batch'.format(time.time() - compute_start))
+        else:
+            compute_time.update(time.time() - compute_start)
+        batch_time.update(time.time() - end)
+        end = time.time()
 
-            if it % args.print_freq == 0:
-                print('Epoch: [{0}][{1}/{2}]\t Time {3}\t Data {4}\t Loss {5}\t EPE {6}'
-                      .format(epoch, it, epoch_size, batch_time,
-                              data_time, losses, flow2_EPEs))
+        if it % args.print_freq == 0:
+            print('Epoch: [{0}][{1}/{2}]\t Time {3}\t Data {4}\t Loss {5}\t EPE {6}'
+                  .format(epoch, it, epoch_size, batch_time,
+                          data_time, losses, flow2_EPEs))
+        if optimizer_step:
+            # do optimization step
+            optimizer.step()
+            optimizer.zero_grad()
+            train_writer.add_scalar('train_loss', step_loss, n_iter)
+            log_terms(step_terms, train_writer)
+            step_loss = 0
+            step_terms = {}
             n_iter += 1
-            if it >= epoch_size:
-                break
+            if snapshot is not None and args.snapshot_interval > 0 and n_iter % args.snapshot_interval == 0:
+                snapshot(epoch, it + 1, {'losses': reduce_meter(losses), 'flow2_EPEs': reduce_meter(flow2_EPEs)})
+        if it >= epoch_size:
+            break
 
-        return losses.avg, flow2_EPEs.avg
+    if args.compile and compute_time.count > 0:
+        print('=> compiled step: steady state {:.1f} pairs/s'.format(args.batch_size / compute_time.avg))
 
+    return reduce_meter(losses)['avg'], reduce_meter(flow2_EPEs)['avg']
 
-    else:
-        # use self-supervised loss
-        for it, (input, target) in enumerate(train_loader):
-            # measure data loading time
-            data_time.update(time.time() - end)
-            target = target.to(device)
-            im1 = input[0].to(device)
-            im2 = input[1].to(device)
-            input = torch.cat(input,1).to(device)
-            pred = model(input)
-
-            pl_loss = 0
-            pl_loss_list = []
-            for i in range(len(pred)):
-                flow = pred[i] * args.div_flow
-                loss = photometric_loss(im1, im2, flow, config)
-                pl_loss += loss
-                pl_loss_list.append(loss.item())
-
-                if not config['multiscale_pl_loss']:
-                    break
-
-            sl_loss = 0
-            sl_loss_list = []
-            if config['weighted_sl_loss']:
-                for i in range(len(pred)):
-                    flow = pred[i] * args.div_flow
-                    loss = weighted_smoothness_loss(im1, im2, flow, config)
-                    sl_loss += loss
-                    sl_loss_list.append(loss.item())
-
-                    if not config['multiscale_sl_loss']:
-                        break
-
-            else:
-                # smoothness loss for multi resolution flow pyramid
-                for i in range(len(pred)):
-                    flow = pred[i] * args.div_flow
-                    loss = smoothness_loss(flow, config)
-                    sl_loss += loss
-                    sl_loss_list.append(loss.item())
-
-                    if not config['multiscale_sl_loss']:
-                        break
-            # to check the magnitude of both losses
-            if it % 500 == 0:
-                print("[DEBUG] pl_loss:", str(pl_loss_list))
-                print("[DEBUG] sl_loss:", str(sl_loss_list))
-
-            loss = pl_loss + sl_loss
-
-            # record loss and EPE
-            flow = pred[0]
-            losses.update(loss.item(), target.size(0))
-            flow2_EPE = args.div_flow * realEPE(flow, target, sparse=args.sparse)
-            train_writer.add_scalar('train_loss', loss.item(), n_iter)
-            train_writer.add_scalar('train_loss_pl', pl_loss.item(), n_iter)
-            train_writer.add_scalar('train_loss_sl', sl_loss.item(), n_iter)
-            flow2_EPEs.update(flow2_EPE.item(), target.size(0))
-
-            # compute gradient and do optimization step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
 
-            # measure elapsed time
-            batch_time.update(time.time() - end)
-            end = time.time()
-
-            if it % args.print_freq == 0:
-                print('Epoch: [{0}][{1}/{2}]\t Time {3}\t Data {4}\t Loss {5}\t EPE {6}'
-                      .format(epoch, it, epoch_size, batch_time,
-                              data_time, losses, flow2_EPEs))
-            n_iter += 1
-            if it >= epoch_size:
-                break
-
-        return losses.avg, flow2_EPEs.avg
+def reduce_meter(meter):
+    """state of an AverageMeter with the sum and count of all processes, for the logs and the snapshots"""
+    state = dict(meter.__dict__)
+    if distributed:
+        totals = torch.tensor([meter.sum, meter.count], dtype=torch.float64, device=device)
+        torch.distributed.all_reduce(totals)
+        state['sum'], state['count'] = totals.tolist()
+        state['avg'] = state['sum'] / max(state['count'], 1)
+    return state
 
 def validate(val_loader, model, epoch, output_writers):
 
@@ -517,7 +728,9 @@ def validate(val_loader, model, epoch, output_writers):
         input = torch.cat(input,1).to(device)
 
         # compute output
-        output = model(input)
+        with autocast(device, args.precision):
+            output = model(input)
+        output = output.float()
         flow2_EPE = args.div_flow*realEPE(output, target, sparse=args.sparse)
         # record EPE
         flow2_EPEs.update(flow2_EPE.item(), target.size(0))
@@ -529,10 +742,10 @@ def validate(val_loader, model, epoch, output_writers):
         if i < len(output_writers):  # log first output of first batches
             if epoch == 0:
                 mean_values = torch.tensor([0.45,0.432,0.411], dtype=input.dtype).view(3,1,1)
-                output_writers[i].add_image('GroundTruth', flow2rgb(args.div_flow * target[0], max_value=10), 0)
+                output_writers[i].add_image('GroundTruth', flow_to_color(args.div_flow * target[:1], max_value=10)[0], 0)
                 output_writers[i].add_image('Inputs', (input[0,:3].cpu() + mean_values).clamp(0,1), 0)
                 output_writers[i].add_image('Inputs', (input[0,3:].cpu() + mean_values).clamp(0,1), 1)
-            output_writers[i].add_image('FlowNet Outputs', flow2rgb(args.div_flow * output[0], max_value=10), epoch)
+            output_writers[i].add_image('FlowNet Outputs', flow_to_color(args.div_flow * output[:1], max_value=10)[0], epoch)
 
         if i % args.print_freq == 0:
             print('Test: [{0}/{1}]\t Time {2}\t EPE {3}'
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.nn.init import kaiming_normal_, constant_
-from .util import conv, predict_flow, deconv, crop_like, correlate
+from .util import conv, predict_flow, deconv, crop_like, correlate, checkpointed
 
 __all__ = [
     'flownetc', 'flownetc_bn'
@@ -15,6 +15,8 @@ class FlowNetC(nn.Module):
         super(FlowNetC,self).__init__()
 
         self.batchNorm = batchNorm
+        # recompute the encoder stages during backward instead of keeping their activations
+        self.checkpoint_activations = False
         self.conv1      = conv(self.batchNorm,   3,   64, kernel_size=7, stride=2)
         self.conv2      = conv(self.batchNorm,  64,  128, kernel_size=5, stride=2)
         self.conv3      = conv(self.batchNorm, 128,  256, kernel_size=5, stride=2)
@@ -53,44 +55,61 @@ class FlowNetC(nn.Module):
                 constant_(m.weight, 1)
                 constant_(m.bias, 0)
 
-    def forward(self, x):
+    def forward(self, x, exit_level=2):
+        # exit_level: stop decoding at flow{exit_level} (2 to 6) and return it at its native resolution, in eval mode
         x1 = x[:,:3]
         x2 = x[:,3:]
 
-        out_conv1a = self.conv1(x1)
-        out_conv2a = self.conv2(out_conv1a)
-        out_conv3a = self.conv3(out_conv2a)
+        return self.decode(self.encode(x1), self.encode(x2), exit_level)
 
-        out_conv1b = self.conv1(x2)
-        out_conv2b = self.conv2(out_conv1b)
-        out_conv3b = self.conv3(out_conv2b)
+    def encode(self, x):
+        # siamese features of a single image, they can be reused for every pair the image belongs to
+        out_conv1 = checkpointed(self.checkpoint_activations, self.conv1, x)
+        out_conv2 = checkpointed(self.checkpoint_activations, self.conv2, out_conv1)
+        out_conv3 = checkpointed(self.checkpoint_activations, self.conv3, out_conv2)
+        return out_conv2, out_conv3
+
+    def decode(self, features_a, features_b, exit_level=2):
+        # early exits only apply in eval mode, training needs the flows of every scale for the multiscale loss
+        if self.training:
+            exit_level = 2
+        out_conv2a, out_conv3a = features_a
+        _, out_conv3b = features_b
 
         out_conv_redir = self.conv_redir(out_conv3a)
         out_correlation = correlate(out_conv3a,out_conv3b)
 
         in_conv3_1 = torch.cat([out_conv_redir, out_correlation], dim=1)
 
-        out_conv3 = self.conv3_1(in_conv3_1)
-        out_conv4 = self.conv4_1(self.conv4(out_conv3))
-        out_conv5 = self.conv5_1(self.conv5(out_conv4))
-        out_conv6 = self.conv6_1(self.conv6(out_conv5))
+        out_conv3 = checkpointed(self.checkpoint_activations, self.conv3_1, in_conv3_1)
+        out_conv4 = checkpointed(self.checkpoint_activations, (self.conv4, self.conv4_1), out_conv3)
+        out_conv5 = checkpointed(self.checkpoint_activations, (self.conv5, self.conv5_1), out_conv4)
+        out_conv6 = checkpointed(self.checkpoint_activations, (self.conv6, self.conv6_1), out_conv5)
 
         flow6       = self.predict_flow6(out_conv6)
+        if exit_level == 6:
+            return flow6
         flow6_up    = crop_like(self.upsampled_flow6_to_5(flow6), out_conv5)
         out_deconv5 = crop_like(self.deconv5(out_conv6), out_conv5)
 
         concat5 = torch.cat((out_conv5,out_deconv5,flow6_up),1)
         flow5       = self.predict_flow5(concat5)
+        if exit_level == 5:
+            return flow5
         flow5_up    = crop_like(self.upsampled_flow5_to_4(flow5), out_conv4)
         out_deconv4 = crop_like(self.deconv4(concat5), out_conv4)
 
         concat4 = torch.cat((out_conv4,out_deconv4,flow5_up),1)
         flow4       = self.predict_flow4(concat4)
+        if exit_level == 4:
+            return flow4
         flow4_up    = crop_like(self.upsampled_flow4_to_3(flow4), out_conv3)
         out_deconv3 = crop_like(self.deconv3(concat4), out_conv3)
 
         concat3 = torch.cat((out_conv3,out_deconv3,flow4_up),1)
         flow3       = self.predict_flow3(concat3)
+        if exit_level == 3:
+            return flow3
         flow3_up    = crop_like(self.upsampled_flow3_to_2(flow3), out_conv2a)
         out_deconv2 = crop_like(self.deconv2(concat3), out_conv2a)
 
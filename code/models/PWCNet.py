@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import collections
 import getopt
 import math
 import numpy
@@ -12,38 +13,147 @@ import PIL
 import PIL.Image
 import sys
 
-from .correlation import correlation
+from .correlation.native import spatial_correlation
+from .util import checkpointed
 
 __all__ = ['pwcnet']
 
-backwarp_tenGrid = {}
-backwarp_tenPartial = {}
+class BackwarpCache(object):
+	# least recently used cache for the sampling grids of backwarp, keyed by (height, width, device, dtype)
+	# the cached tensors have a batch size of one and are expanded on lookup, so the batch size does not create new entries
+	def __init__(self, intCapacity=16):
+		self.intCapacity = intCapacity
+		self.objEntries = collections.OrderedDict()
+		self.intHits = 0
+		self.intMisses = 0
+		self.intEvictions = 0
+	# end
+
+	def get(self, tenFlow):
+		intBatch, _, intHeight, intWidth = tenFlow.shape
+		objKey = (intHeight, intWidth, tenFlow.device, tenFlow.dtype)
+
+		if objKey in self.objEntries:
+			self.intHits += 1
+			self.objEntries.move_to_end(objKey)
+
+		else:
+			self.intMisses += 1
+
+			tenHorizontal = torch.linspace(-1.0, 1.0, intWidth, device=tenFlow.device, dtype=tenFlow.dtype).view(1, 1, 1, intWidth).expand(-1, -1, intHeight, -1)
+			tenVertical = torch.linspace(-1.0, 1.0, intHeight, device=tenFlow.device, dtype=tenFlow.dtype).view(1, 1, intHeight, 1).expand(-1, -1, -1, intWidth)
+
+			self.objEntries[objKey] = ( torch.cat([ tenHorizontal, tenVertical ], 1), tenFlow.new_ones([ 1, 1, intHeight, intWidth ]) )
+
+			while len(self.objEntries) > self.intCapacity:
+				self.objEntries.popitem(last=False)
+				self.intEvictions += 1
+			# end
+
+		# end
+
+		tenGrid, tenPartial = self.objEntries[objKey]
+
+		return tenGrid.expand(intBatch, -1, -1, -1), tenPartial.expand(intBatch, -1, -1, -1)
+	# end
+
+	def clear(self):
+		self.objEntries.clear()
+	# end
+
+	def stats(self):
+		return {
+			'size': len(self.objEntries),
+			'capacity': self.intCapacity,
+			'hits': self.intHits,
+			'misses': self.intMisses,
+			'evictions': self.intEvictions
+		}
+	# end
+# end
+
+def backwarp(tenInput, tenFlow, objCache):
+	# the sampling grid is built and sampled in float32 even under autocast, bfloat16 cannot address the pixels precisely
+	with torch.autocast(device_type=tenInput.device.type, enabled=False):
+		tenGrid, tenPartial = objCache.get(tenFlow.float())
+
+		tenFlow = torch.cat([ tenFlow[:, 0:1, :, :].float() / ((tenInput.shape[3] - 1.0) / 2.0), tenFlow[:, 1:2, :, :].float() / ((tenInput.shape[2] - 1.0) / 2.0) ], 1)
+		tenOutput = torch.cat([ tenInput.float(), tenPartial ], 1)
+
+		tenOutput = torch.nn.functional.grid_sample(input=tenOutput, grid=(tenGrid + tenFlow).permute(0, 2, 3, 1), mode='bilinear', padding_mode='zeros', align_corners=True)
+
+		tenMask = tenOutput[:, -1:, :, :]; tenMask[tenMask > 0.999] = 1.0; tenMask[tenMask < 1.0] = 0.0
 
-def backwarp(tenInput, tenFlow):
-	if str(tenFlow.size()) not in backwarp_tenGrid:
-		tenHorizontal = torch.linspace(-1.0, 1.0, tenFlow.shape[3]).view(1, 1, 1, tenFlow.shape[3]).expand(tenFlow.shape[0], -1, tenFlow.shape[2], -1)
-		tenVertical = torch.linspace(-1.0, 1.0, tenFlow.shape[2]).view(1, 1, tenFlow.shape[2], 1).expand(tenFlow.shape[0], -1, -1, tenFlow.shape[3])
+		return (tenOutput[:, :-1, :, :] * tenMask).to(tenInput.dtype)
+	# end
+# end
+
+def forward_warp(tenInput, tenFlow):
+	# splats every pixel of tenInput to its nearest target position along tenFlow (in pixels of tenInput)
+	# colliding pixels are averaged, positions that receive nothing keep their original value
+	intBatch, intChannels, intHeight, intWidth = tenInput.shape
+
+	tenX = (torch.arange(intWidth, device=tenFlow.device, dtype=tenFlow.dtype).view(1, 1, intWidth) + tenFlow[:, 0, :, :]).round().long()
+	tenY = (torch.arange(intHeight, device=tenFlow.device, dtype=tenFlow.dtype).view(1, intHeight, 1) + tenFlow[:, 1, :, :]).round().long()
+	tenValid = (tenX >= 0) & (tenX < intWidth) & (tenY >= 0) & (tenY < intHeight)
+
+	tenIndex = (torch.arange(intBatch, device=tenFlow.device).view(intBatch, 1, 1) * intHeight + tenY) * intWidth + tenX
+	tenIndex = tenIndex[tenValid]
+	tenValues = tenInput.permute(0, 2, 3, 1)[tenValid]
+
+	tenSum = tenInput.new_zeros([ intBatch * intHeight * intWidth, intChannels ]).index_add_(0, tenIndex, tenValues)
+	tenCount = tenInput.new_zeros([ intBatch * intHeight * intWidth ]).index_add_(0, tenIndex, tenValues.new_ones([ tenValues.shape[0] ]))
+
+	tenOutput = (tenSum / tenCount.clamp(min=1.0).unsqueeze(1)).view(intBatch, intHeight, intWidth, intChannels).permute(0, 3, 1, 2)
+
+	return torch.where(tenCount.view(intBatch, 1, intHeight, intWidth) > 0.0, tenOutput, tenInput)
+# end
+
+objCupyCorrelation = []
+
+def cupy_correlation():
+	# imports the cupy kernels on first use only, None if cupy is not installed
+	if len(objCupyCorrelation) == 0:
+		try:
+			from .correlation import correlation
+		except ImportError:
+			correlation = None
+		# end
 
-		backwarp_tenGrid[str(tenFlow.size())] = torch.cat([ tenHorizontal, tenVertical ], 1).cuda()
+		objCupyCorrelation.append(correlation)
 	# end
 
-	if str(tenFlow.size()) not in backwarp_tenPartial:
-		backwarp_tenPartial[str(tenFlow.size())] = tenFlow.new_ones([ tenFlow.shape[0], 1, tenFlow.shape[2], tenFlow.shape[3] ])
+	return objCupyCorrelation[0]
+# end
+
+def correlate(tenFirst, tenSecond, intRange, intStride):
+	# the cupy kernels are hard-wired to a dense 9x9 window, everything else goes through the native implementation
+	if tenFirst.is_cuda == True and intRange == 4 and intStride == 1 and cupy_correlation() is not None:
+		# the kernels read float32 memory, bfloat16 features under autocast have to be converted first
+		with torch.autocast(device_type='cuda', enabled=False):
+			return cupy_correlation().FunctionCorrelation(tenFirst=tenFirst.float(), tenSecond=tenSecond.float()).to(tenFirst.dtype)
+		# end
 	# end
 
-	tenFlow = torch.cat([ tenFlow[:, 0:1, :, :] / ((tenInput.shape[3] - 1.0) / 2.0), tenFlow[:, 1:2, :, :] / ((tenInput.shape[2] - 1.0) / 2.0) ], 1)
-	tenInput = torch.cat([ tenInput, backwarp_tenPartial[str(tenFlow.size())] ], 1)
+	return spatial_correlation(tenFirst, tenSecond, max_displacement=intRange, dilation=intStride)
+# end
 
-	tenOutput = torch.nn.functional.grid_sample(input=tenInput, grid=(backwarp_tenGrid[str(tenFlow.size())] + tenFlow).permute(0, 2, 3, 1), mode='bilinear', padding_mode='zeros', align_corners=True)
+def per_level(objValue):
+	# a single value for all decoders, or one value per decoder ordered from the finest (level 2) to the coarsest (level 6)
+	if isinstance(objValue, int):
+		objValue = [ objValue ] * 5
+	elif len(objValue) == 1:
+		objValue = list(objValue) * 5
+	# end
 
-	tenMask = tenOutput[:, -1:, :, :]; tenMask[tenMask > 0.999] = 1.0; tenMask[tenMask < 1.0] = 0.0
+	assert(len(objValue) == 5), 'expected one value per pyramid level (2 to 6)'
 
-	return tenOutput[:, :-1, :, :] * tenMask
+	return { intLevel: int(objValue[intLevel - 2]) for intLevel in range(2, 7) }
 # end
 
 
 class Network(torch.nn.Module):
-	def __init__(self):
+	def __init__(self, intSearchRange=4, intSearchStride=1, intCacheSize=16):
 		super(Network, self).__init__()
 
 		class Extractor(torch.nn.Module):
@@ -118,11 +228,18 @@ class Network(torch.nn.Module):
 		# end
 
 		class Decoder(torch.nn.Module):
-			def __init__(self, intLevel):
+			def __init__(self, intLevel, intRange, intStride, intPreviousRange, objCache):
 				super(Decoder, self).__init__()
 
-				intPrevious = [ None, None, 81 + 32 + 2 + 2, 81 + 64 + 2 + 2, 81 + 96 + 2 + 2, 81 + 128 + 2 + 2, 81, None ][intLevel + 1]
-				intCurrent = [ None, None, 81 + 32 + 2 + 2, 81 + 64 + 2 + 2, 81 + 96 + 2 + 2, 81 + 128 + 2 + 2, 81, None ][intLevel + 0]
+				self.intRange = intRange
+				self.intStride = intStride
+				self.objCache = objCache
+
+				# without autograd, the features are written into one preallocated buffer instead of being concatenated
+				self.boolBuffer = True
+
+				if intLevel < 6: intPrevious = (2 * intPreviousRange + 1) ** 2 + [ None, None, 32 + 2 + 2, 64 + 2 + 2, 96 + 2 + 2, 128 + 2 + 2, 0, None ][intLevel + 1]
+				intCurrent = (2 * intRange + 1) ** 2 + [ None, None, 32 + 2 + 2, 64 + 2 + 2, 96 + 2 + 2, 128 + 2 + 2, 0, None ][intLevel + 0]
 
 				if intLevel < 6: self.netUpflow = torch.nn.ConvTranspose2d(in_channels=2, out_channels=2, kernel_size=4, stride=2, padding=1)
 				if intLevel < 6: self.netUpfeat = torch.nn.ConvTranspose2d(in_channels=intPrevious + 128 + 128 + 96 + 64 + 32, out_channels=2, kernel_size=4, stride=2, padding=1)
@@ -158,49 +275,99 @@ class Network(torch.nn.Module):
 				)
 			# end
 
+			def features(self, tenInputs):
+				# same as concatenating [ netFiv, netFou, netThr, netTwo, netOne, tenInputs ] as in forward, but every output is
+				# written into its channel slice of a single buffer and every conv reads the suffix of the buffer holding its input,
+				# which copies each feature once instead of once per conv. A channel suffix is only contiguous within one sample,
+				# the convs run sample by sample so that they never get a strided view they would have to copy first
+				intInput = sum([ tenInput.shape[1] for tenInput in tenInputs ])
+				intTotal = intInput + 128 + 128 + 96 + 64 + 32
+
+				tenFeat = tenInputs[0].new_empty([ tenInputs[0].shape[0], intTotal, tenInputs[0].shape[2], tenInputs[0].shape[3] ])
+
+				intOffset = intTotal - intInput
+				for tenInput in tenInputs:
+					tenFeat[:, intOffset:intOffset + tenInput.shape[1], :, :] = tenInput
+					intOffset += tenInput.shape[1]
+				# end
+
+				for intSample in range(tenFeat.shape[0]):
+					tenSample = tenFeat[intSample:intSample + 1, :, :, :]
+
+					intOffset = intTotal - intInput
+					for netConv in [ self.netOne, self.netTwo, self.netThr, self.netFou, self.netFiv ]:
+						tenOutput = netConv(tenSample[:, intOffset:, :, :])
+						tenSample[:, intOffset - tenOutput.shape[1]:intOffset, :, :] = tenOutput
+						intOffset -= tenOutput.shape[1]
+					# end
+				# end
+
+				return tenFeat
+			# end
+
 			def forward(self, tenFirst, tenSecond, objPrevious):
 				tenFlow = None
 				tenFeat = None
+				tenUpfeat = None
 
 				if objPrevious is None:
 					tenFlow = None
 					tenFeat = None
 
-					tenVolume = torch.nn.functional.leaky_relu(input=correlation.FunctionCorrelation(tenFirst=tenFirst, tenSecond=tenSecond), negative_slope=0.1, inplace=False)
+					tenVolume = torch.nn.functional.leaky_relu(input=correlate(tenFirst, tenSecond, self.intRange, self.intStride), negative_slope=0.1, inplace=False)
 
-					tenFeat = torch.cat([ tenVolume ], 1)
+					tenInputs = [ tenVolume ]
 
 				elif objPrevious is not None:
-					tenFlow = self.netUpflow(objPrevious['tenFlow'])
-					tenFeat = self.netUpfeat(objPrevious['tenFeat'])
+					if 'tenUpflow' in objPrevious:
+						# warm start, the upsampled estimate of the coarser level is given directly
+						tenFlow = objPrevious['tenUpflow']
+						tenFeat = objPrevious['tenUpfeat']
 
-					tenVolume = torch.nn.functional.leaky_relu(input=correlation.FunctionCorrelation(tenFirst=tenFirst, tenSecond=backwarp(tenInput=tenSecond, tenFlow=tenFlow * self.fltBackwarp)), negative_slope=0.1, inplace=False)
+					else:
+						tenFlow = self.netUpflow(objPrevious['tenFlow'])
+						tenFeat = self.netUpfeat(objPrevious['tenFeat'])
 
-					tenFeat = torch.cat([ tenVolume, tenFirst, tenFlow, tenFeat ], 1)
+					# end
+
+					tenUpfeat = tenFeat
+
+					tenVolume = torch.nn.functional.leaky_relu(input=correlate(tenFirst, backwarp(tenInput=tenSecond, tenFlow=tenFlow * self.fltBackwarp, objCache=self.objCache), self.intRange, self.intStride), negative_slope=0.1, inplace=False)
+
+					tenInputs = [ tenVolume, tenFirst, tenFlow, tenFeat ]
 
 				# end
 
-				tenFeat = torch.cat([ self.netOne(tenFeat), tenFeat ], 1)
-				tenFeat = torch.cat([ self.netTwo(tenFeat), tenFeat ], 1)
-				tenFeat = torch.cat([ self.netThr(tenFeat), tenFeat ], 1)
-				tenFeat = torch.cat([ self.netFou(tenFeat), tenFeat ], 1)
-				tenFeat = torch.cat([ self.netFiv(tenFeat), tenFeat ], 1)
+				if self.boolBuffer == True and torch.is_grad_enabled() == False:
+					tenFeat = self.features(tenInputs)
+
+				else:
+					# autograd needs every intermediate anyway, and must not see them overwritten in place
+					tenFeat = torch.cat(tenInputs, 1)
+					tenFeat = torch.cat([ self.netOne(tenFeat), tenFeat ], 1)
+					tenFeat = torch.cat([ self.netTwo(tenFeat), tenFeat ], 1)
+					tenFeat = torch.cat([ self.netThr(tenFeat), tenFeat ], 1)
+					tenFeat = torch.cat([ self.netFou(tenFeat), tenFeat ], 1)
+					tenFeat = torch.cat([ self.netFiv(tenFeat), tenFeat ], 1)
+
+				# end
 
 				tenFlow = self.netSix(tenFeat)
 
 				return {
 					'tenFlow': tenFlow,
-					'tenFeat': tenFeat
+					'tenFeat': tenFeat,
+					'tenUpfeat': tenUpfeat
 				}
 			# end
 		# end
 
 		class Refiner(torch.nn.Module):
-			def __init__(self):
+			def __init__(self, intRange):
 				super(Refiner, self).__init__()
 
 				self.netMain = torch.nn.Sequential(
-					torch.nn.Conv2d(in_channels=81 + 32 + 2 + 2 + 128 + 128 + 96 + 64 + 32, out_channels=128, kernel_size=3, stride=1, padding=1, dilation=1),
+					torch.nn.Conv2d(in_channels=(2 * intRange + 1) ** 2 + 32 + 2 + 2 + 128 + 128 + 96 + 64 + 32, out_channels=128, kernel_size=3, stride=1, padding=1, dilation=1),
 					torch.nn.LeakyReLU(inplace=False, negative_slope=0.1),
 					torch.nn.Conv2d(in_channels=128, out_channels=128, kernel_size=3, stride=1, padding=2, dilation=2),
 					torch.nn.LeakyReLU(inplace=False, negative_slope=0.1),
@@ -221,56 +388,159 @@ class Network(torch.nn.Module):
 			# end
 		# end
 
+		intRanges = per_level(intSearchRange)
+		intStrides = per_level(intSearchStride)
+
+		self.objBackwarpCache = BackwarpCache(intCacheSize)
+
 		self.netExtractor = Extractor()
 
-		self.netTwo = Decoder(2)
-		self.netThr = Decoder(3)
-		self.netFou = Decoder(4)
-		self.netFiv = Decoder(5)
-		self.netSix = Decoder(6)
+		self.netTwo = Decoder(2, intRanges[2], intStrides[2], intRanges[3], self.objBackwarpCache)
+		self.netThr = Decoder(3, intRanges[3], intStrides[3], intRanges[4], self.objBackwarpCache)
+		self.netFou = Decoder(4, intRanges[4], intStrides[4], intRanges[5], self.objBackwarpCache)
+		self.netFiv = Decoder(5, intRanges[5], intStrides[5], intRanges[6], self.objBackwarpCache)
+		self.netSix = Decoder(6, intRanges[6], intStrides[6], None, self.objBackwarpCache)
+
+		self.netRefiner = Refiner(intRanges[2])
 
-		self.netRefiner = Refiner()
+		# recompute every decoder and the refiner during backward instead of keeping their activations
+		self.boolCheckpoint = False
 
 
-	def forward(self, tenFirst, tenSecond):
-		tenFirst = self.netExtractor(tenFirst)
-		tenSecond = self.netExtractor(tenSecond)
+	def forward(self, tenFirst, tenSecond, intLevel=2):
+		return self.decode(self.netExtractor(tenFirst), self.netExtractor(tenSecond), intLevel)
+	# end
 
-		objEstimate = self.netSix(tenFirst[-1], tenSecond[-1], None)
-		objEstimate = self.netFiv(tenFirst[-2], tenSecond[-2], objEstimate)
-		objEstimate = self.netFou(tenFirst[-3], tenSecond[-3], objEstimate)
-		objEstimate = self.netThr(tenFirst[-4], tenSecond[-4], objEstimate)
-		objEstimate = self.netTwo(tenFirst[-5], tenSecond[-5], objEstimate)
+	def decode(self, tenFirst, tenSecond, intLevel=2, objInit=None, intInitLevel=6, objEstimates=None):
+		# tenFirst, tenSecond: feature pyramids of netExtractor
+		# intLevel: last decoder to run, the refiner only runs after the finest decoder (level 2)
+		# objInit: upsampled estimate ('tenUpflow' and 'tenUpfeat') to start the decoder of intInitLevel with, the coarser decoders are skipped
+		# objEstimates: if given, the output of every decoder that ran is stored in it, keyed by level
+		objEstimate = objInit
+
+		for intDecoder, netDecoder in [ (6, self.netSix), (5, self.netFiv), (4, self.netFou), (3, self.netThr), (2, self.netTwo) ]:
+			if intDecoder > intInitLevel:
+				continue
+			# end
+
+			objEstimate = checkpointed(self.boolCheckpoint, netDecoder, tenFirst[intDecoder - 1], tenSecond[intDecoder - 1], objEstimate)
+
+			if objEstimates is not None:
+				objEstimates[intDecoder] = objEstimate
+			# end
 
-		return objEstimate['tenFlow'] + self.netRefiner(objEstimate['tenFeat'])
+			if intDecoder == intLevel:
+				break
+			# end
+		# end
+
+		if intLevel > 2:
+			return objEstimate['tenFlow']
+		# end
+
+		return objEstimate['tenFlow'] + checkpointed(self.boolCheckpoint, self.netRefiner, objEstimate['tenFeat'])
 	# end
 # end
 
 
 class PWCNet(nn.Module):
 
-    def __init__(self):
+    def __init__(self, search_range=4, search_stride=1, backwarp_cache_size=16,
+                 preprocess='resize', pad_mode='replicate'):
         super().__init__()
-        self.network = Network()
-
-    def forward(self, x):
+        assert preprocess in ['resize', 'pad'], "preprocess should be either 'resize' or 'pad'"
+        assert pad_mode in ['replicate', 'zero'], "pad_mode should be either 'replicate' or 'zero'"
+        self.preprocess = preprocess
+        self.pad_mode = pad_mode
+        self.search_range = search_range
+        self.search_stride = search_stride
+        self.network = Network(search_range, search_stride, backwarp_cache_size)
+        # 4 entries (levels 3 to 6) per input size, device and dtype
+        self.backwarp_cache = self.network.objBackwarpCache
+
+    @property
+    def checkpoint_activations(self):
+        # recompute the decoders and the refiner during backward instead of keeping their activations
+        return self.network.boolCheckpoint
+
+    @checkpoint_activations.setter
+    def checkpoint_activations(self, enabled):
+        self.network.boolCheckpoint = enabled
+
+    def forward(self, x, exit_level=2, upsample=True):
         # x: batch x 6 x H x W
-        im0, im1 = x[:, :3, :, :], x[:, 3:, :, :]
+        # exit_level: stop decoding after the decoder of this level (2 to 6), the refiner only runs for level 2
+        # upsample: return the flow at the input resolution, otherwise at the native resolution of exit_level
+        assert x.shape[1] == 6, "expected two RGB images stacked along the channels, B x 6 x H x W, got {} channels".format(x.shape[1])
+
+        intHeight, intWidth = x.shape[2:]
+
+        x = self.preprocess_input(x)
+
+        tenFlow = 20.0 * self.network(x[:, :3, :, :], x[:, 3:, :, :], exit_level)
+
+        return self.postprocess(tenFlow, intHeight, intWidth, upsample)
+
+    def encode(self, im):
+        # feature pyramid of a single image, it can be reused for every pair the image belongs to
+        return self.network.netExtractor(self.preprocess_input(im)), tuple(im.shape[2:])
 
-        assert im0.shape == im1.shape, "Two input images should have the same shape!"
+    def decode(self, features_a, features_b, exit_level=2, upsample=True, init=None, init_level=6, estimates=None):
+        # init, init_level, estimates: see warm_start
+        (tenFirst, (intHeight, intWidth)), (tenSecond, _) = features_a, features_b
 
-        intHeight, intWidth = im0.shape[2:]
+        tenFlow = 20.0 * self.network.decode(tenFirst, tenSecond, exit_level, init, init_level, estimates)
+
+        return self.postprocess(tenFlow, intHeight, intWidth, upsample)
+
+    def warm_start(self, estimates, level):
+        """Initial estimate for the decoder of `level` on pair (t, t+1), from the decoder outputs of pair (t-1, t).
+
+        `estimates` is the dict filled by decode(..., estimates=estimates) for the previous pair. Assuming
+        constant motion, its finest flow and the upsampled features of `level` are splatted forward along
+        that flow. Pass the result as decode(..., init=init, init_level=level) to skip the coarser decoders.
+        """
+        tenUpfeat = estimates[level]['tenUpfeat']
+        assert tenUpfeat is not None, "the coarsest level (6) cannot be warm started"
+
+        tenFlow = F.interpolate(input=estimates[min(estimates)]['tenFlow'], size=tenUpfeat.shape[2:], mode='bilinear', align_corners=False)
+        # the network predicts flow / 20 in pixels of the full resolution
+        tenDisplacement = tenFlow * 20.0 / 2 ** level
+
+        return {
+            'tenUpflow': forward_warp(tenFlow, tenDisplacement),
+            'tenUpfeat': forward_warp(tenUpfeat, tenDisplacement)
+        }
+
+    def preprocess_input(self, x):
+        # bring the inputs to a multiple of 64, either one image or both images stacked along the channels
+        intHeight, intWidth = x.shape[2:]
 
         intPreprocessedWidth = int(math.floor(math.ceil(intWidth / 64.0) * 64.0))
         intPreprocessedHeight = int(math.floor(math.ceil(intHeight / 64.0) * 64.0))
 
-        im0 = F.interpolate(input=im0, size=(intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
-        im1 = F.interpolate(input=im1, size=(intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
+        if self.preprocess == 'pad':
+            # pad on the bottom right, the flow of the original pixels is cropped out in postprocess
+            padding = (0, intPreprocessedWidth - intWidth, 0, intPreprocessedHeight - intHeight)
+            return F.pad(x, padding, mode='replicate' if self.pad_mode == 'replicate' else 'constant')
 
-        tenFlow = 20.0 * F.interpolate(input=self.network(im0, im1), size=(intHeight, intWidth), mode='bilinear', align_corners=False)
+        return F.interpolate(input=x, size=(intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
 
-        tenFlow[:, 0, :, :] *= float(intWidth) / float(intPreprocessedWidth)
-        tenFlow[:, 1, :, :] *= float(intHeight) / float(intPreprocessedHeight)
+    def postprocess(self, tenFlow, intHeight, intWidth, upsample=True):
+        # bring the flow predicted for the preprocessed inputs back to the original intHeight x intWidth frame
+        intPreprocessedWidth = int(math.floor(math.ceil(intWidth / 64.0) * 64.0))
+        intPreprocessedHeight = int(math.floor(math.ceil(intHeight / 64.0) * 64.0))
+
+        if self.preprocess == 'pad':
+            if upsample:
+                tenFlow = F.interpolate(input=tenFlow, size=(intPreprocessedHeight, intPreprocessedWidth), mode='bilinear', align_corners=False)
+            tenFlow = tenFlow[:, :, :int(math.ceil(intHeight * tenFlow.shape[2] / intPreprocessedHeight)),
+                                    :int(math.ceil(intWidth * tenFlow.shape[3] / intPreprocessedWidth))]
+        else:
+            if upsample:
+                tenFlow = F.interpolate(input=tenFlow, size=(intHeight, intWidth), mode='bilinear', align_corners=False)
+            tenFlow[:, 0, :, :] *= float(intWidth) / float(intPreprocessedWidth)
+            tenFlow[:, 1, :, :] *= float(intHeight) / float(intPreprocessedHeight)
 
         if self.training:
             return [tenFlow]
@@ -283,8 +553,25 @@ class PWCNet(nn.Module):
         return [param for name, param in self.named_parameters() if 'bias' in name]
 
 
-def pwcnet(data=None):
-    model = PWCNet()
+def pwcnet(data=None, search_range=4, search_stride=1, preprocess='resize', pad_mode='replicate'):
+    """PWC-Net model architecture from the
+    "PWC-Net: CNNs for Optical Flow Using Pyramid, Warping, and Cost Volume" paper (https://arxiv.org/abs/1709.02371)
+
+    Args:
+        data : pretrained weights of the network. will create a new one if not set
+        search_range : radius of the cost volume search window, 4 (9x9 window) in the paper.
+            Either one value for all levels or five values from the finest to the coarsest level.
+        search_stride : pixel distance between two displacements of the search window, same format.
+            A stride > 1 covers a larger motion range at the same cost.
+        preprocess : how inputs are brought to a multiple of 64, 'resize' (bilinear resize of the images and the flow)
+            or 'pad' (pad the images, crop the flow)
+        pad_mode : 'replicate' or 'zero' padding, only used with preprocess='pad'
+    The decoder widths are derived from the search range. Settings stored in `data` take precedence.
+    """
+    if data is not None:
+        search_range = data.get('search_range', search_range)
+        search_stride = data.get('search_stride', search_stride)
+    model = PWCNet(search_range, search_stride, preprocess=preprocess, pad_mode=pad_mode)
     if data is not None:
         model.load_state_dict(data['state_dict'])
     return model
\ No newline at end of file
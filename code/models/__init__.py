@@ -1,3 +1,30 @@
-from .FlowNetS import *
-from .FlowNetC import *
-from .PWCNet import *
\ No newline at end of file
+import importlib
+
+# architecture name -> module defining it. A module is only imported when one of its architectures is
+# requested, so that e.g. flownets can be used without the optional dependencies of the other models
+_architectures = {
+    'flownets': 'FlowNetS',
+    'flownets_bn': 'FlowNetS',
+    'flownetc': 'FlowNetC',
+    'flownetc_bn': 'FlowNetC',
+    'pwcnet': 'PWCNet',
+}
+
+model_names = sorted(_architectures)
+
+__all__ = ['get', 'model_names']
+
+
+def get(arch):
+    """constructor of the architecture `arch`, e.g. get('flownets')(data)"""
+    if arch not in _architectures:
+        raise KeyError('unknown architecture {}, choose one of {}'.format(arch, ', '.join(model_names)))
+    module = importlib.import_module('.' + _architectures[arch], __name__)
+    return getattr(module, arch)
+
+
+def __getattr__(name):
+    # models.flownets etc. keep working, through the lazy import
+    if name in _architectures:
+        return get(name)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,101 @@
+import torch
+import torch.nn.functional as F
+
+
+'''
+Pure PyTorch cost volume, used when neither the spatial_correlation_sampler
+extension nor the CuPy kernels are available (or when they do not support the
+requested search window).
+
+The output volume is filled one displacement at a time, with one product and
+one channel reduction each. The only temporary is a single feature-sized product
+buffer that is reused for every displacement, so peak memory stays at roughly
+inputs + output + one feature map regardless of the size of the search window.
+Correlating the 2r+1 displacements of a row at once (overlapping unfolded views
+of input2, then a single reduction) needs 2r+1 feature maps of temporaries and
+was measured 2 to 4 times slower on CPU, the loop is bound by memory traffic
+rather than by its Python iterations.
+'''
+
+
+def _displacements(max_displacement, dilation):
+    patch_size = 2 * max_displacement + 1
+    for row in range(patch_size):
+        for col in range(patch_size):
+            yield row * patch_size + col, row * dilation, col * dilation
+
+
+def _correlation_forward(input1, input2, max_displacement, dilation):
+    b, c, h, w = input1.size()
+    patch_size = 2 * max_displacement + 1
+    pad = max_displacement * dilation
+
+    padded2 = F.pad(input2, (pad, pad, pad, pad))
+    output = input1.new_empty(b, patch_size * patch_size, h, w)
+    product = torch.empty_like(input1)
+
+    for k, y, x in _displacements(max_displacement, dilation):
+        torch.mul(input1, padded2[:, :, y:y + h, x:x + w], out=product)
+        torch.sum(product, 1, out=output[:, k])
+
+    return output.div_(c)
+
+
+def _correlation_backward(grad_output, input1, input2, max_displacement, dilation,
+                          needs_grad1=True, needs_grad2=True):
+    b, c, h, w = input1.size()
+    pad = max_displacement * dilation
+
+    padded2 = F.pad(input2, (pad, pad, pad, pad))
+    grad1 = torch.zeros_like(input1) if needs_grad1 else None
+    grad2 = torch.zeros_like(padded2) if needs_grad2 else None
+
+    for k, y, x in _displacements(max_displacement, dilation):
+        grad_k = grad_output[:, k:k + 1]
+        if needs_grad1:
+            grad1.addcmul_(grad_k, padded2[:, :, y:y + h, x:x + w])
+        if needs_grad2:
+            grad2[:, :, y:y + h, x:x + w].addcmul_(grad_k, input1)
+
+    if needs_grad1:
+        grad1.div_(c)
+    if needs_grad2:
+        grad2 = grad2[:, :, pad:pad + h, pad:pad + w].div_(c)
+    return grad1, grad2
+
+
+class _NativeCorrelation(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, input1, input2, max_displacement, dilation):
+        ctx.save_for_backward(input1, input2)
+        ctx.max_displacement = max_displacement
+        ctx.dilation = dilation
+        with torch.no_grad():
+            return _correlation_forward(input1, input2, max_displacement, dilation)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input1, input2 = ctx.saved_tensors
+        grad1, grad2 = _correlation_backward(grad_output.contiguous(), input1, input2,
+                                             ctx.max_displacement, ctx.dilation,
+                                             needs_grad1=ctx.needs_input_grad[0],
+                                             needs_grad2=ctx.needs_input_grad[1])
+        return grad1, grad2, None, None
+
+
+def spatial_correlation(input1, input2, max_displacement=4, dilation=1):
+    """Correlate every pixel of input1 with a (2*max_displacement+1)^2 window of input2
+
+    Args:
+        input1, input2: feature maps of shape [B, C, H, W]
+        max_displacement: search radius, in displacement steps
+        dilation: pixel distance between two neighbouring displacements
+
+    Returns:
+        cost volume of shape [B, (2*max_displacement+1)^2, H, W], averaged over channels.
+        Channels are ordered row-major, vertical displacement first, which matches both
+        spatial_correlation_sampler and the CuPy kernels used by PWCNet.
+    """
+    assert input1.size() == input2.size(), "Both feature maps should have the same shape!"
+    return _NativeCorrelation.apply(input1, input2, max_displacement, dilation)
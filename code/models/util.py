@@ -1,14 +1,48 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from .correlation.native import spatial_correlation
 
-try:
-    from spatial_correlation_sampler import spatial_correlation_sample
-except ImportError as e:
-    import warnings
-    with warnings.catch_warnings():
-        warnings.filterwarnings("default", category=ImportWarning)
-        warnings.warn("failed to load custom correlation module"
-                      "which is needed for FlowNetC", ImportWarning)
+_correlation_sampler = []
+
+
+def correlation_sampler():
+    """spatial_correlation_sample, imported on first use only, or None if it is not installed"""
+    if not _correlation_sampler:
+        try:
+            from spatial_correlation_sampler import spatial_correlation_sample
+        except ImportError as e:
+            spatial_correlation_sample = None
+            import warnings
+            with warnings.catch_warnings():
+                warnings.filterwarnings("default", category=ImportWarning)
+                warnings.warn("failed to load custom correlation module, "
+                              "FlowNetC will use the slower native correlation", ImportWarning)
+        _correlation_sampler.append(spatial_correlation_sample)
+    return _correlation_sampler[0]
+
+
+def checkpointed(enabled, stage, *inputs):
+    """stage(*inputs), stage is a module or a tuple of modules applied one after the other. If enabled and gradients
+    are computed, the activations inside the stage are not kept for backward but recomputed from its inputs, trading
+    compute for memory. Stages with batch norm layers are never recomputed, that would update their running
+    statistics a second time per step"""
+    layers = stage if isinstance(stage, tuple) else (stage,)
+    if enabled and torch.is_grad_enabled() and not has_batch_norm(*layers):
+        return checkpoint(_chain, layers, *inputs, use_reentrant=False)
+    return _chain(layers, *inputs)
+
+
+def _chain(layers, *inputs):
+    output = layers[0](*inputs)
+    for layer in layers[1:]:
+        output = layer(output)
+    return output
+
+
+def has_batch_norm(*modules):
+    return any(isinstance(m, nn.modules.batchnorm._BatchNorm) for module in modules for m in module.modules())
 
 
 def conv(batchNorm, in_planes, out_planes, kernel_size=3, stride=1):
@@ -37,6 +71,12 @@ def deconv(in_planes, out_planes):
 
 
 def correlate(input1, input2):
+    spatial_correlation_sample = correlation_sampler()
+    if spatial_correlation_sample is None:
+        # 21x21 patch with dilation 2, already normalized by the number of channels
+        out_corr = spatial_correlation(input1, input2, max_displacement=10, dilation=2)
+        return F.leaky_relu_(out_corr, 0.1)
+
     out_corr = spatial_correlation_sample(input1,
                                           input2,
                                           kernel_size=1,
@@ -1,7 +1,9 @@
 import torch
 import torch.nn.functional as F
+from precision import float32
 
 
+@float32
 def EPE(input_flow, target_flow, sparse=False, mean=True):
     EPE_map = torch.norm(target_flow-input_flow,2,1)
     batch_size = EPE_map.size(0)
@@ -1,17 +1,19 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-import torchvision
 import ssim_module
+from precision import float32
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
+@float32
 def charbonnier_loss(input, alpha):
     eps = 1e-9 # from reference implementation
     sq = torch.pow(input,2) + eps*eps
     return torch.mean(torch.pow(sq, alpha))
 
 
+@float32
 def image_warp(image, flow, with_mask=False):
     if image.shape[2] != flow.shape[2]:
         flow = F.interpolate(input=flow, scale_factor=image.shape[2]/flow.shape[2], mode='bilinear')
@@ -23,7 +25,7 @@ def image_warp(image, flow, with_mask=False):
     yy = torch.arange(0, H).view(-1, 1).repeat(1, W)
     xx = xx.view(1, 1, H, W).repeat(B, 1, 1, 1)
     yy = yy.view(1, 1, H, W).repeat(B, 1, 1, 1)
-    grid = torch.cat((xx, yy), 1).float().to(device)
+    grid = torch.cat((xx, yy), 1).float().to(flow.device)
     vgrid = grid + flow
 
     # scale grid to [-1,1]
@@ -35,7 +37,7 @@ def image_warp(image, flow, with_mask=False):
     output = F.grid_sample(image, vgrid)
 
     if with_mask:
-        mask = torch.autograd.Variable(torch.ones(flow.size())).cuda()
+        mask = torch.ones(flow.size(), device=flow.device)
         mask = F.grid_sample(mask, vgrid)
         mask[mask < 0.9999] = 0
         mask[mask > 0] = 1
@@ -67,6 +69,26 @@ def length_sq(mat):
     return torch.sum(torch.pow(mat, 2), dim=1, keepdim=True)
 
 
+def forward_backward_check(flow_fw, flow_bw):
+    """ forward-backward consistency check of UnFlow (Meister et al., 2018), both directions in one batch.
+    Returns the differences flow + warped opposite flow and the occlusion maps (1 where the check fails),
+    each as a (forward, backward) pair
+    """
+    flows = torch.cat([flow_fw, flow_bw])
+    flows_warped = image_warp(torch.cat([flow_bw, flow_fw]), flows)
+    flow_diff = flows + flows_warped
+    mag_sq = length_sq(flows) + length_sq(flows_warped)
+    occ_thresh = 0.01 * mag_sq + 0.5
+    fb_occ = (length_sq(flow_diff) > occ_thresh).float()
+    return flow_diff.chunk(2), fb_occ.chunk(2)
+
+
+def forward_backward_occlusion(flow_fw, flow_bw):
+    """ occlusion maps (B x 1 x H x W, 1 for occluded) of the forward and backward flows, in pixels
+    """
+    return forward_backward_check(flow_fw, flow_bw)[1]
+
+
 def forward_backward_loss(im1, im2, flow_fw, flow_bw, config):
     fb_weight = config['fb_weight']
     fb_exp = config['fb_exp']
@@ -77,17 +99,7 @@ def forward_backward_loss(im1, im2, flow_fw, flow_bw, config):
     im2_warped, mask_fw = image_warp(im2, flow_fw, with_mask=True)
     im1_warped, mask_bw = image_warp(im1, flow_bw, with_mask=True)
 
-    flow_bw_warped = image_warp(flow_bw, flow_fw)
-    flow_fw_warped = image_warp(flow_fw, flow_bw)
-    flow_diff_fw = flow_fw + flow_bw_warped
-    flow_diff_bw = flow_bw + flow_fw_warped
-    mag_sq_fw = length_sq(flow_fw) + length_sq(flow_bw_warped)
-    mag_sq_bw = length_sq(flow_bw) + length_sq(flow_fw_warped)
-    occ_thresh_fw =  0.01 * mag_sq_fw + 0.5
-    occ_thresh_bw =  0.01 * mag_sq_bw + 0.5
-
-    fb_occ_fw = (length_sq(flow_diff_fw) > occ_thresh_fw).float()
-    fb_occ_bw = (length_sq(flow_diff_bw) > occ_thresh_bw).float()
+    (flow_diff_fw, flow_diff_bw), (fb_occ_fw, fb_occ_bw) = forward_backward_check(flow_fw, flow_bw)
     mask_fw *= (1 - fb_occ_fw)
     mask_bw *= (1 - fb_occ_bw)
 
@@ -238,6 +250,7 @@ def _second_order_deltas(flow):
 
 
 
+@float32
 def charbonnier_loss_unflow(x, mask=None, truncate=None, alpha=0.45, beta=1.0, epsilon=0.001):
     """Compute the generalized charbonnier loss of the difference tensor x.
     All positions where mask == 0 are not taken into account.
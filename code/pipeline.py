@@ -0,0 +1,137 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class StageStats(object):
+    """Accumulates the busy time of one pipeline stage over all its workers"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, items=1):
+        with self.lock:
+            self.busy += seconds
+            self.items += items
+
+    def utilisation(self, wall):
+        return self.busy / max(wall * self.workers, 1e-9)
+
+    def __repr__(self):
+        return '{}: {} items, {:.1f}s busy'.format(self.name, self.items, self.busy)
+
+
+def timed(fn, stats, items=lambda *args: 1):
+    def wrapper(*args):
+        start = time.perf_counter()
+        result = fn(*args)
+        stats.add(time.perf_counter() - start, items(*args))
+        return result
+    return wrapper
+
+
+class InferencePipeline(object):
+    """Overlaps decoding, inference and encoding of image pairs.
+
+    A pool of reader threads runs `load(item) -> (input, meta)` ahead of the model, consecutive inputs
+    of the same shape are stacked into batches of up to `batch_size` and passed to `infer(batch) -> outputs`
+    on the calling thread, and every batch of results is handed to a pool of writer threads running
+    `write(metas, outputs)`, so that encoders can work on whole batches. Both queues are bounded by
+    `queue_size` items, so a slow stage throttles the others instead of piling up decoded images or
+    results in memory.
+
+    `load` may also return `(None, meta, output)` for items whose output is already known, e.g. from a
+    cache. These skip the model and are batched and written like the others.
+
+    Args:
+        load, infer, write: the three stages, see above. infer should return CPU tensors so that
+            writers do not touch the device
+        batch_size: maximum number of pairs per forward pass
+        read_workers, write_workers: number of threads of the reader and writer pools
+        queue_size: maximum number of decoded inputs and of pending writes
+    """
+
+    def __init__(self, load, infer, write, batch_size=1, read_workers=4, write_workers=2, queue_size=16):
+        self.load = load
+        self.infer = infer
+        self.write = write
+        self.batch_size = batch_size
+        self.read_workers = read_workers
+        self.write_workers = write_workers
+        self.queue_size = max(queue_size, batch_size)
+        self.stats = None
+
+    @staticmethod
+    def _key(sample):
+        if sample[0] is None:
+            return 'precomputed', sample[2].shape
+        return 'input', sample[0].shape
+
+    def _batches(self, readers, items, load):
+        items = iter(items)
+        loads = collections.deque()
+
+        def fill():
+            for item in items:
+                loads.append(readers.submit(load, item))
+                if len(loads) >= self.queue_size:
+                    break
+
+        fill()
+        batch = []
+        while loads:
+            sample = loads.popleft().result()
+            fill()
+            if batch and self._key(sample) != self._key(batch[0]):
+                yield batch
+                batch = []
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, items):
+        """processes all items, returns a dict of throughput and per stage utilisation"""
+        read_stats = StageStats('read', self.read_workers)
+        infer_stats = StageStats('infer', 1)
+        write_stats = StageStats('write', self.write_workers)
+        load = timed(self.load, read_stats)
+        write = timed(self.write, write_stats, items=lambda metas, outputs: len(metas))
+
+        start = time.perf_counter()
+        precomputed = 0
+        writes = collections.deque()
+        with ThreadPoolExecutor(self.read_workers) as readers, ThreadPoolExecutor(self.write_workers) as writers:
+            for batch in self._batches(readers, items, load):
+                if batch[0][0] is None:
+                    outputs = torch.stack([torch.as_tensor(sample[2]) for sample in batch])
+                    precomputed += len(batch)
+                else:
+                    infer_start = time.perf_counter()
+                    outputs = self.infer(torch.stack([sample[0] for sample in batch]))
+                    infer_stats.add(time.perf_counter() - infer_start, len(batch))
+
+                while sum(n for n, _ in writes) + len(batch) > self.queue_size:
+                    writes.popleft()[1].result()
+                writes.append((len(batch), writers.submit(write, [sample[1] for sample in batch], outputs)))
+            while writes:
+                writes.popleft()[1].result()
+        wall = time.perf_counter() - start
+
+        self.stats = {
+            'pairs': infer_stats.items + precomputed,
+            'precomputed': precomputed,
+            'seconds': wall,
+            'pairs_per_second': (infer_stats.items + precomputed) / max(wall, 1e-9),
+            'utilisation': {s.name: s.utilisation(wall) for s in [read_stats, infer_stats, write_stats]}
+        }
+        return self.stats
@@ -0,0 +1,44 @@
+import functools
+
+import torch
+
+'''
+Reduced precision helpers. With --precision bfloat16, the models and losses run under torch.autocast, which
+computes convolutions and matrix products in bfloat16. The few computations that lose too much with an 8 bit
+mantissa (sampling grids, powers of small numbers, variances as differences of squares, error sums) are
+wrapped with float32 and always run in full precision.
+'''
+
+PRECISIONS = ['float32', 'bfloat16']
+
+
+def autocast(device, precision='float32'):
+    """autocast context for the device, a no-op in float32"""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bfloat16')
+
+
+def autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:  # torch < 2.4
+        return torch.is_autocast_cpu_enabled() if device_type == 'cpu' else torch.is_autocast_enabled()
+
+
+def float32(fn):
+    """runs fn with autocast disabled, floating point tensor arguments are cast to float32"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [arg for arg in list(args) + list(kwargs.values()) if torch.is_tensor(arg)]
+        if not tensors or not autocast_enabled(tensors[0].device.type):
+            return fn(*args, **kwargs)
+        with torch.autocast(device_type=tensors[0].device.type, enabled=False):
+            args = [to_float32(arg) for arg in args]
+            kwargs = {key: to_float32(value) for key, value in kwargs.items()}
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def to_float32(value):
+    if torch.is_tensor(value) and value.is_floating_point():
+        return value.float()
+    return value
@@ -1,4 +1,6 @@
 import argparse
+import itertools
+import time
 from path import Path
 
 import torch
@@ -11,24 +13,55 @@ import torchvision.transforms as transforms
 import flow_transforms
 from imageio import imread, imwrite
 import numpy as np
-from util import flow2rgb
+from pipeline import InferencePipeline
+from streaming import StreamingFlow
+from tiling import TiledInference
+from util import flow_to_color
 
 from datasets.listdataset import load_flo
+from checkpoint import load_checkpoint
+from precision import PRECISIONS, autocast
+from flow_io import flow_writer
+from own_loss import forward_backward_occlusion
+from flow_cache import FlowCache, file_hash, pair_hash
+from directory import CompletionManifest, iter_frames, iter_pairs, parse_shard
 
-model_names = sorted(name for name in models.__dict__
-                     if name.islower() and not name.startswith("__"))
+model_names = models.model_names
 
 
 parser = argparse.ArgumentParser(description='PyTorch FlowNet inference on a folder of img pairs',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('data', metavar='DIR',
                     help='path to images folder, image names must match \'[name]0.[ext]\' and \'[name]1.[ext]\'')
+parser.add_argument('--sequence', action='store_true',
+                    help='treat DIR as a video: compute the flow between consecutive frames, in file name order.'
+                    ' Each frame is encoded only once for pwcnet and flownetc')
+parser.add_argument('--tile-size', default=None, type=int, nargs=2, metavar=('H', 'W'),
+                    help='split large image pairs into overlapping tiles of this size, the output is always at full resolution')
+parser.add_argument('--tile-overlap', default=128, type=int, metavar='PX',
+                    help='number of pixels shared by neighbouring tiles')
+parser.add_argument('--memory-budget', default=None, type=float, metavar='MB',
+                    help='with --tile-size, activation memory available to a batch of tiles. If not set, tiles are processed one by one')
+parser.add_argument('--warm-start-level', default=None, type=int, choices=[2, 3, 4, 5],
+                    help='pwcnet with --sequence only: start decoding at this level from the forward warped flow of the'
+                    ' previous pair, skipping the coarser decoders')
+parser.add_argument('--refresh-interval', default=10, type=int, metavar='N',
+                    help='with --warm-start-level, decode one pair from scratch after N warm started pairs')
 parser.add_argument('pretrained', metavar='PTH', help='path to pre-trained model')
 parser.add_argument('--output', '-o', metavar='DIR', default=None,
                     help='path to output folder. If not set, will be created in data folder')
 parser.add_argument('--output-value', '-v', choices=['raw', 'vis', 'both'], default='both',
                     help='which value to output, between raw input (as a npy file) and color vizualisation (as an image file).'
                     ' If not set, will output both')
+parser.add_argument('--output-format', choices=['npy', 'flo', 'kitti', 'archive'], default='npy',
+                    help='file format of the raw output: numpy array, Middlebury .flo, KITTI 16bit PNG'
+                    ' or compressed .npz archives of --archive-size flow maps')
+parser.add_argument('--output-dtype', choices=['float32', 'float16'], default='float32',
+                    help='precision of the raw output for the npy and archive formats')
+parser.add_argument('--archive-size', default=64, type=int, metavar='N',
+                    help='number of flow maps per archive with --output-format archive')
+parser.add_argument('--no-gt', action='store_true',
+                    help='do not save a visualization of the ground truth flow next to the output')
 parser.add_argument('--div-flow', default=20, type=float,
                     help='value by which flow will be divided. overwritten if stored in pretrained file')
 parser.add_argument("--img-exts", metavar='EXT', default=['png', 'jpg', 'bmp', 'ppm'], nargs='*', type=str,
@@ -37,10 +70,45 @@ parser.add_argument('--max_flow', default=None, type=float,
                     help='max flow value. Flow map color is saturated above this value. If not set, will use flow map\'s max value')
 parser.add_argument('--upsampling', '-u', choices=['nearest', 'bilinear'], default=None, help='if not set, will output FlowNet raw input,'
                     'which is 4 times downsampled. If set, will output full resolution flow map, with selected upsampling')
-parser.add_argument('--bidirectional', type=str, default=False)
+parser.add_argument('--inverse', action='store_true',
+                    help='swap the images of every pair, i.e. compute the backward flow')
+parser.add_argument('--bidirectional', action='store_true',
+                    help='compute the forward and backward flows in one batch, along with forward-backward'
+                    ' occlusion masks. Outputs are always at full resolution')
 parser.add_argument('--device', type=str, default=None)
+parser.add_argument('--shard', default=None, metavar='i/n',
+                    help='only process the i-th of n disjoint subsets of the pairs (i from 0), to split a folder between'
+                    ' several processes sharing the output folder')
+parser.add_argument('--overwrite', action='store_true',
+                    help='recompute pairs already listed in the completion manifest of the output folder')
+parser.add_argument('--cache', metavar='DIR', default=None,
+                    help='on-disk cache of network outputs, keyed by checkpoint, image content and inference options')
+parser.add_argument('--cache-size', default=10240, type=float, metavar='MB',
+                    help='the least recently used entries are evicted above this size')
+parser.add_argument('--batch-size', '-b', default=1, type=int,
+                    help='number of image pairs per forward pass, consecutive pairs of different sizes are not batched')
+parser.add_argument('--read-workers', default=4, type=int, help='threads decoding input images')
+parser.add_argument('--write-workers', default=2, type=int, help='threads encoding and writing outputs')
+parser.add_argument('--queue-size', default=16, type=int,
+                    help='maximum number of decoded pairs waiting for the model, and of outputs waiting to be written')
+parser.add_argument('--preprocess', choices=['resize', 'pad'], default='resize',
+                    help='pwcnet only: bring inputs to a multiple of 64 by resizing them or by padding them and cropping the flow')
+parser.add_argument('--pad-mode', choices=['replicate', 'zero'], default='replicate',
+                    help='pwcnet only: padding used with --preprocess pad')
+parser.add_argument('--exit-level', default=2, type=int, choices=[2, 3, 4, 5, 6],
+                    help='stop decoding at this pyramid level, the flow is 2^level times downsampled.'
+                    ' Combine with --upsampling to get a full resolution flow map')
+parser.add_argument('--precision', choices=PRECISIONS, default='float32',
+                    help='bfloat16 runs the model under autocast, outputs are saved in float32 either way')
+parser.add_argument('--latency-budget', default=None, type=float, metavar='MS',
+                    help='pick the finest exit level whose forward pass fits in this many milliseconds,'
+                    ' measured on the first pair. Overrides --exit-level')
 
 args = parser.parse_args()
+if args.bidirectional and (args.inverse or args.sequence):
+    parser.error('--bidirectional cannot be combined with --inverse or --sequence')
+if args.sequence and (args.tile_size is not None or args.inverse or args.shard is not None or args.cache is not None):
+    parser.error('--sequence cannot be combined with --tile-size, --inverse, --shard or --cache')
 
 if args.device is not None:
     device = torch.device(args.device)
@@ -48,9 +116,84 @@ else:
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def pick_exit_level(model, input_var, budget, repeat=3):
+    """finest exit level whose mean forward time on input_var is within budget milliseconds"""
+    for level in [2, 3, 4, 5, 6]:
+        model(input_var, exit_level=level)
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(input_var, exit_level=level)
+        synchronize()
+        latency = 1000 * (time.perf_counter() - start) / repeat
+        print('=> exit level {}: {:.1f} ms'.format(level, latency))
+        if latency <= budget:
+            return level
+    print('=> no exit level fits in {} ms, using the coarsest one'.format(budget))
+    return 6
+
+
+def save_outputs(filenames, flow_outputs, gts=None):
+    """saves a batch of B x 2 x H x W flows, filenames are given without extension.
+    Returns the names of the outputs that are completely written"""
+    done = [filename.basename() for filename in filenames]
+    if args.output_value in['vis', 'both']:
+        rgb_flows = flow_to_color(args.div_flow * flow_outputs, max_value=args.max_flow).cpu().numpy()
+        for filename, to_save in zip(filenames, rgb_flows.transpose(0,2,3,1)):
+            imwrite(filename + '.png', to_save)
+    if args.output_value in ['raw', 'both']:
+        # Make the flow maps Bx HxWx2 arrays as in .flo files
+        done = writer.write(filenames, (args.div_flow*flow_outputs).cpu().numpy().transpose(0,2,3,1))
+    if gts is not None and not args.no_gt:
+        for filename, gt in zip(filenames, gts):
+            if gt is not None:
+                gt_flow = flow_to_color(torch.from_numpy(gt.transpose(2,0,1)).unsqueeze(0), max_value=args.max_flow)
+                imwrite(filename + '_gt.png', gt_flow[0].numpy().transpose(1,2,0))
+    return done
+
+
+def output_names(img1_file):
+    """names of the flow outputs of a pair, without folder and extension"""
+    name = '{}flow'.format(img1_file.namebase[:-1])
+    if args.bidirectional:
+        return [name + '_fw', name + '_bw']
+    return [name]
+
+
+def save_masks(filenames, occlusions):
+    """saves a batch of B x 2 x H x W forward and backward occlusion masks as black and white images"""
+    masks = (255 * occlusions).to(torch.uint8).numpy()
+    for filename, mask in zip(filenames, masks):
+        imwrite(filename + '_occ_fw.png', mask[0])
+        imwrite(filename + '_occ_bw.png', mask[1])
+
+
+@torch.no_grad()
+def run_sequence(model, frames, input_transform, forward_kwargs):
+    stream = StreamingFlow(model, warm_start_level=args.warm_start_level, refresh_interval=args.refresh_interval,
+                           exit_level=args.exit_level, **forward_kwargs)
+    previous_file = None
+    for frame_file in tqdm(frames):
+        frame = input_transform(imread(frame_file)).unsqueeze(0).to(device)
+        with autocast(device, args.precision):
+            output = stream.push(frame)
+        if output is not None:
+            output = output.float()
+            if args.upsampling is not None:
+                output = F.interpolate(output, size=frame.size()[-2:], mode=args.upsampling, align_corners=False)
+            save_outputs([save_path/'{}_flow'.format(previous_file.namebase)], output)
+        previous_file = frame_file
+
+
 @torch.no_grad()
 def main():
-    global save_path
+    global save_path, writer
 
     if args.output_value == 'both':
         output_string = "raw output and RGB visualization"
@@ -67,6 +210,7 @@ def main():
         save_path = Path(args.output)
     print('=> will save everything to {}'.format(save_path))
     save_path.makedirs_p()
+    writer = flow_writer(args.output_format, save_path, dtype=np.dtype(args.output_dtype), chunk_size=args.archive_size)
     # Data loading code
     input_transform = transforms.Compose([
         flow_transforms.ArrayToTensor(),
@@ -74,56 +218,161 @@ def main():
         transforms.Normalize(mean=[0.411,0.432,0.45], std=[1,1,1])
     ])
 
-    img_pairs = []
-    for ext in args.img_exts:
-        test_files = data_dir.files('*1.{}'.format(ext))
-        for file in test_files:
-            img_pair = file.parent / (file.namebase[:-1] + '2.{}'.format(ext))
-            img_gt = file.parent / (file.namebase[:-4] + 'flow.flo')
-            if img_pair.isfile():
-                img_pairs.append([file, img_pair, img_gt])
+    img_pairs = iter([])
+    manifest = None
+    skipped = [0]
+    if args.sequence:
+        frames = iter_frames(data_dir, args.img_exts)
+        print('{} frames found'.format(len(frames)))
+    else:
+        shard = parse_shard(args.shard) if args.shard is not None else None
+        manifest = CompletionManifest(save_path, shard)
+        if args.overwrite:
+            manifest.done.clear()
+        elif manifest.done:
+            print('=> resuming, {} outputs already done'.format(len(manifest.done)))
+
+        def skip(img1_file):
+            if all(name in manifest for name in output_names(img1_file)):
+                skipped[0] += 1
+                return True
+            return False
 
-    print('{} samples found'.format(len(img_pairs)))
+        # pairs are enumerated lazily, while the first ones are processed
+        img_pairs = iter_pairs(data_dir, args.img_exts, shard, skip)
     # create model
-    network_data = torch.load(args.pretrained)
+    network_data = load_checkpoint(args.pretrained, map_location=device)
     print("=> using pre-trained model '{}'".format(network_data['arch']))
-    model = models.__dict__[network_data['arch']](network_data).to(device)
+    if network_data['arch'] == 'pwcnet':
+        model = models.get(network_data['arch'])(network_data, preprocess=args.preprocess,
+                                                 pad_mode=args.pad_mode).to(device)
+    else:
+        model = models.get(network_data['arch'])(network_data).to(device)
     model.eval()
     cudnn.benchmark = True
 
     if 'div_flow' in network_data.keys():
         args.div_flow = network_data['div_flow']
 
-    for (img1_file, img2_file, gt_file) in tqdm(img_pairs):
+    cache = None
 
-        img1 = input_transform(imread(img1_file))
-        img2 = input_transform(imread(img2_file))
-        gt = load_flo(gt_file)
-        input_var = torch.cat([img1, img2]).unsqueeze(0)
+    def load(pair):
+        img1_file, img2_file, gt_file = pair
+        gt = load_flo(gt_file) if gt_file.isfile() and not args.no_gt else None
+        content1, content2 = img1_file.bytes(), img2_file.bytes()
+        key = None
+        if cache is not None:
+            key = cache.key(pair_hash(content1, content2))
+            output = cache.get(key)
+            if output is not None:
+                return None, (img1_file, gt, None), output
+        img1 = input_transform(imread(content1))
+        img2 = input_transform(imread(content2))
+        input_var = torch.cat([img1, img2])
 
-        if args.bidirectional:
-            # feed inverted pair along with normal pair
-            input_var = torch.cat([img2, img1]).unsqueeze(0)
+        if args.inverse:
+            input_var = torch.cat([img2, img1])
+
+        return input_var, (img1_file, gt, key)
+
+    if args.latency_budget is not None:
+        input_var = None
+        if args.sequence:
+            if len(frames) > 1:
+                input_var = torch.cat([input_transform(imread(frames[0])), input_transform(imread(frames[1]))])
+        else:
+            first_pair = next(img_pairs, None)
+            if first_pair is not None:
+                img_pairs = itertools.chain([first_pair], img_pairs)
+                input_var = load(first_pair)[0]
+        if input_var is not None:
+            args.exit_level = pick_exit_level(model, input_var.unsqueeze(0).to(device), args.latency_budget)
+            print('=> using exit level {}'.format(args.exit_level))
 
+    if args.bidirectional and args.upsampling is None:
+        # the consistency check needs both flows at full resolution
+        print('=> bidirectional mode, using bilinear upsampling')
+        args.upsampling = 'bilinear'
 
+    forward_kwargs = {}
+    if network_data['arch'] == 'pwcnet':
+        # pwcnet upsamples its output by itself, only keep the native resolution when asked to exit early
+        forward_kwargs['upsample'] = args.upsampling is not None or args.exit_level == 2
+
+    if args.sequence:
+        run_sequence(model, frames, input_transform, forward_kwargs)
+        writer.close()
+        return
+
+    tiler = None
+    if args.tile_size is not None:
+        tiler = TiledInference(model, args.tile_size, overlap=args.tile_overlap, memory_budget=args.memory_budget,
+                               exit_level=args.exit_level, **forward_kwargs)
+
+    def infer(input_var):
         input_var = input_var.to(device)
-        # compute output
-        output = model(input_var)
-        if args.upsampling is not None:
-            output = F.interpolate(output, size=img1.size()[-2:], mode=args.upsampling, align_corners=False)
-        for suffix, flow_output in zip(['flow', 'inv_flow'], output):
-            filename = save_path/'{}{}'.format(img1_file.namebase[:-1], suffix)
-            if args.output_value in['vis', 'both']:
-                rgb_flow = flow2rgb(args.div_flow * flow_output, max_value=args.max_flow)
-                to_save = (rgb_flow * 255).astype(np.uint8).transpose(1,2,0)
-                imwrite(filename + '.png', to_save)
-            if args.output_value in ['raw', 'both']:
-                # Make the flow map a HxWx2 array as in .flo files
-                to_save = (args.div_flow*flow_output).cpu().numpy().transpose(1,2,0)
-                np.save(filename + '.npy', to_save)
-            gt_flow = flow2rgb(gt.transpose(2,0,1), max_value=args.max_flow)
-            gt_save = (gt_flow * 255).astype(np.uint8).transpose(1,2,0)
-            imwrite(filename + '_gt.png', gt_save)
+        if args.bidirectional:
+            # (im1, im2) and (im2, im1) in a single batch
+            input_var = torch.cat([input_var, torch.cat([input_var[:, 3:], input_var[:, :3]], 1)])
+        with autocast(device, args.precision):
+            if tiler is not None:
+                output = torch.cat([tiler(pair.unsqueeze(0)) for pair in input_var])
+            else:
+                output = model(input_var, exit_level=args.exit_level, **forward_kwargs)
+        output = output.float()
+        if tiler is None and args.upsampling is not None:
+            output = F.interpolate(output, size=input_var.size()[-2:], mode=args.upsampling, align_corners=False)
+        if args.bidirectional:
+            flow_fw, flow_bw = output.chunk(2)
+            occ_fw, occ_bw = forward_backward_occlusion(args.div_flow * flow_fw, args.div_flow * flow_bw)
+            # B x 6 x H x W: forward flow, backward flow, forward and backward occlusions
+            output = torch.cat([flow_fw, flow_bw, occ_fw, occ_bw], 1)
+        return output.cpu()
+
+    if args.cache is not None and not args.sequence:
+        options = {'arch': network_data['arch'], 'exit_level': args.exit_level, 'upsampling': args.upsampling,
+                   'preprocess': args.preprocess, 'pad_mode': args.pad_mode, 'inverse': args.inverse,
+                   'bidirectional': args.bidirectional,
+                   'tile_size': args.tile_size, 'tile_overlap': args.tile_overlap}
+        if args.precision != 'float32':
+            # only set for reduced precisions, so that existing float32 entries keep their keys
+            options['precision'] = args.precision
+        cache = FlowCache(args.cache, file_hash(args.pretrained), options, max_size=args.cache_size)
+        print('=> using flow cache {} ({} entries)'.format(args.cache, len(cache.entries)))
+
+    def write(metas, flow_outputs):
+        filenames = [save_path/'{}flow'.format(img1_file.namebase[:-1]) for img1_file, _, _ in metas]
+        gts = [gt for _, gt, _ in metas]
+        if args.bidirectional:
+            save_masks(filenames, flow_outputs[:, 4:])
+            done = save_outputs([f + '_fw' for f in filenames] + [f + '_bw' for f in filenames],
+                                torch.cat([flow_outputs[:, :2], flow_outputs[:, 2:4]]), gts + [None] * len(gts))
+        else:
+            done = save_outputs(filenames, flow_outputs, gts)
+        manifest.add(done)
+        for (_, _, key), flow_output in zip(metas, flow_outputs):
+            if key is not None:
+                cache.put(key, flow_output.numpy())
+
+    pipeline = InferencePipeline(load, infer, write, batch_size=args.batch_size, read_workers=args.read_workers,
+                                 write_workers=args.write_workers, queue_size=args.queue_size)
+    stats = pipeline.run(tqdm(img_pairs))
+    if manifest is not None:
+        manifest.add(writer.close())
+        manifest.close()
+        print('=> {} pairs processed, {} skipped as already done'.format(stats['pairs'], skipped[0]))
+    else:
+        writer.close()
+    if cache is not None:
+        cache.close()
+        print('=> flow cache: {}'.format(cache.stats()))
+    if stats['pairs'] > 0:
+        print('=> {:.2f} pairs/s, utilisation: {}'.format(
+            stats['pairs_per_second'],
+            ', '.join('{} {:.0%}'.format(name, value) for name, value in stats['utilisation'].items())))
+
+    if hasattr(model, 'backwarp_cache'):
+        print('=> backwarp grid cache: {}'.format(model.backwarp_cache.stats()))
 
 
 if __name__ == '__main__':
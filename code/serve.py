@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import collections
+import json
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+
+import flow_transforms
+import models
+from checkpoint import load_checkpoint
+
+'''
+Local inference server with dynamic batching.
+
+Clients send image pairs over TCP, concurrent requests of the same size are stacked into micro batches
+and the flows are sent back as raw float32 arrays. Every message is a 4 byte big endian header length,
+a JSON header and an optional binary payload:
+
+    request:  {"op": "flow", "height": H, "width": W}, payload: the two H x W x 3 uint8 images
+    response: {"shape": [H, W, 2], "dtype": "float32"}, payload: the flow in pixels, as in .flo files
+    request:  {"op": "metrics"}, response: {"metrics": {...}}, no payload
+
+Errors are returned as {"error": message}.
+'''
+
+model_names = models.model_names
+
+input_transform = transforms.Compose([
+    flow_transforms.ArrayToTensor(),
+    transforms.Normalize(mean=[0,0,0], std=[255,255,255]),
+    transforms.Normalize(mean=[0.411,0.432,0.45], std=[1,1,1])
+])
+
+HEADER = struct.Struct('>I')
+
+
+async def read_message(reader):
+    length, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return json.loads((await reader.readexactly(length)).decode())
+
+
+def write_message(writer, header, payload=b''):
+    header = json.dumps(header).encode()
+    writer.write(HEADER.pack(len(header)) + header + payload)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.latency = 0.
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / max(self.batches, 1),
+            'batch_sizes': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'mean_latency_ms': 1000 * self.latency / max(self.requests, 1)
+        }
+
+
+class FlowServer(object):
+    """Batches concurrent flow requests for one model.
+
+    Requests are grouped by input size. A group is sent to the model as soon as it holds `max_batch_size`
+    pairs, or `max_latency` seconds after its first request arrived, whichever comes first. Batches run
+    one at a time on a worker thread so that the event loop keeps accepting requests meanwhile.
+
+    Args:
+        model: a flow network in eval mode
+        device: device of the model
+        div_flow: scale of the network output, flows are returned in pixels at the input resolution
+        max_batch_size: maximum number of pairs per forward pass
+        max_latency: maximum time in seconds a request waits for others to share its batch
+        forward_kwargs: extra arguments for the model
+    """
+
+    def __init__(self, model, device, div_flow=20, max_batch_size=8, max_latency=0.01, **forward_kwargs):
+        self.model = model
+        self.device = device
+        self.div_flow = div_flow
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.forward_kwargs = forward_kwargs
+        self.metrics = Metrics()
+        self.groups = {}
+        self.deadlines = {}
+        self.executor = ThreadPoolExecutor(1)
+        self.batches = None
+
+    async def start(self):
+        self.batches = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._work())
+
+    async def stop(self):
+        self.worker.cancel()
+        self.executor.shutdown()
+
+    async def submit(self, img1, img2):
+        """img1, img2: H x W x 3 uint8 arrays, returns the H x W x 2 float32 flow"""
+        if img1.shape != img2.shape:
+            raise ValueError('images of different sizes {} and {}'.format(img1.shape, img2.shape))
+        future = asyncio.get_running_loop().create_future()
+        # the images are only converted on the worker thread, not to block the event loop
+        key = tuple(img1.shape[:2])
+        self.groups.setdefault(key, []).append(((img1, img2), future, time.perf_counter()))
+        self.metrics.queue_depth += 1
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.metrics.queue_depth)
+
+        if len(self.groups[key]) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self.deadlines:
+            self.deadlines[key] = asyncio.get_running_loop().call_later(self.max_latency, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            deadline.cancel()
+        group = self.groups.pop(key, [])
+        if group:
+            self.batches.put_nowait(group)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            group = await self.batches.get()
+            try:
+                flows = await loop.run_in_executor(self.executor, self._infer, [images for images, _, _ in group])
+            except Exception as e:
+                for _, future, _ in group:
+                    if not future.done():
+                        future.set_exception(e)
+                flows = None
+            self.metrics.queue_depth -= len(group)
+            if flows is None:
+                continue
+            self.metrics.batches += 1
+            self.metrics.batch_sizes[len(group)] += 1
+            now = time.perf_counter()
+            for flow, (_, future, start) in zip(flows, group):
+                self.metrics.requests += 1
+                self.metrics.latency += now - start
+                if not future.done():
+                    future.set_result(flow)
+
+    @torch.no_grad()
+    def _infer(self, pairs):
+        input_var = torch.stack([torch.cat([input_transform(img1), input_transform(img2)]) for img1, img2 in pairs])
+        input_var = input_var.to(self.device)
+        output = self.model(input_var, **self.forward_kwargs)
+        if output.size()[-2:] != input_var.size()[-2:]:
+            output = F.interpolate(output, size=input_var.size()[-2:], mode='bilinear', align_corners=False)
+        # Make the flow maps Bx HxWx2 arrays as in .flo files
+        return (self.div_flow * output).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    header = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if header.get('op') == 'metrics':
+                    write_message(writer, {'metrics': self.metrics.as_dict()})
+                elif header.get('op') == 'flow':
+                    h, w = header['height'], header['width']
+                    payload = await reader.readexactly(2 * h * w * 3)
+                    images = np.frombuffer(bytearray(payload), np.uint8).reshape(2, h, w, 3)
+                    try:
+                        flow = await self.submit(images[0], images[1])
+                    except Exception as e:
+                        write_message(writer, {'error': str(e)})
+                    else:
+                        write_message(writer, {'shape': list(flow.shape), 'dtype': 'float32'}, flow.tobytes())
+                else:
+                    write_message(writer, {'error': 'unknown op {}'.format(header.get('op'))})
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+class FlowClient(object):
+    """Client of a FlowServer, one connection, one request at a time. Open several clients for concurrent requests"""
+
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        self.writer.close()
+
+    async def flow(self, img1, img2):
+        """img1, img2: H x W x 3 uint8 arrays, returns the H x W x 2 flow"""
+        h, w, _ = img1.shape
+        payload = np.ascontiguousarray(np.stack([img1, img2]), dtype=np.uint8).tobytes()
+        write_message(self.writer, {'op': 'flow', 'height': h, 'width': w}, payload)
+        await self.writer.drain()
+        header = await read_message(self.reader)
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        shape = header['shape']
+        data = await self.reader.readexactly(int(np.prod(shape)) * 4)
+        return np.frombuffer(data, np.float32).reshape(shape)
+
+    async def metrics(self):
+        write_message(self.writer, {'op': 'metrics'})
+        await self.writer.drain()
+        return (await read_message(self.reader))['metrics']
+
+
+def load_model(pretrained, device, arch=None):
+    """model and div_flow of a checkpoint, or a randomly initialized `arch` if pretrained is None"""
+    if pretrained is None:
+        return models.get(arch)().to(device).eval(), 20.
+    network_data = load_checkpoint(pretrained, map_location=device)
+    print("=> using pre-trained model '{}'".format(network_data['arch']))
+    model = models.get(network_data['arch'])(network_data).to(device).eval()
+    return model, network_data.get('div_flow', 20.)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local optical flow inference server with dynamic batching',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('pretrained', metavar='PTH', nargs='?', default=None,
+                        help='path to pre-trained model. If not set, serves a randomly initialized --arch')
+    parser.add_argument('--arch', default='flownets', choices=model_names)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--max-batch-size', default=8, type=int, help='maximum number of pairs per forward pass')
+    parser.add_argument('--max-latency', default=10, type=float, metavar='MS',
+                        help='maximum time a request waits for other requests of the same size')
+    args = parser.parse_args()
+
+    if args.device is not None:
+        device = torch.device(args.device)
+    else:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model, div_flow = load_model(args.pretrained, device, args.arch)
+    server = FlowServer(model, device, div_flow, max_batch_size=args.max_batch_size,
+                        max_latency=args.max_latency / 1000)
+
+    async def serve():
+        await server.start()
+        tcp_server = await asyncio.start_server(server.handle, args.host, args.port)
+        print('=> serving on {}:{}'.format(args.host, args.port))
+        try:
+            await tcp_server.serve_forever()
+        finally:
+            tcp_server.close()
+            await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    print('=> {}'.format(server.metrics.as_dict()))
+
+
+if __name__ == '__main__':
+    main()
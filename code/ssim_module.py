@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
 from math import exp
+from precision import float32
 
 
 def gaussian(window_size, sigma):
@@ -18,6 +19,8 @@ def create_window(window_size, channel):
     return window
 
 
+# the variances are differences of squares, which cancel out in bfloat16
+@float32
 def _ssim(img1, img2, window, window_size, channel, size_average=True):
     mu1 = F.conv2d(img1, window, padding=window_size // 2, groups=channel)
     mu2 = F.conv2d(img2, window, padding=window_size // 2, groups=channel)
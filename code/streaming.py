@@ -0,0 +1,80 @@
+import torch
+
+
+class StreamingFlow(object):
+    """Computes the flow between consecutive frames of a video, one frame at a time.
+
+    Models exposing `encode(image)` and `decode(features_a, features_b, ...)` (pwcnet, flownetc)
+    encode every frame only once: the features of frame t are kept and reused as the first
+    image of pair (t, t+1). Other models (flownets) fuse both images in their first layer,
+    so only the decoded input frame is kept and the full network runs on every pair.
+
+    With warm_start_level (pwcnet only), the flow of the previous pair is splatted forward and
+    used as the initial estimate of the decoder at that level, the coarser decoders are skipped.
+    Every refresh_interval warm started pairs, one pair is decoded from scratch to bound the drift.
+
+    Args:
+        model: a flow network in eval mode
+        warm_start_level: pyramid level (2 to 5) to inject the previous estimate at, None to disable
+        refresh_interval: number of consecutive warm started pairs
+        forward_kwargs: extra arguments for the forward/decode calls, e.g. exit_level
+    """
+
+    def __init__(self, model, warm_start_level=None, refresh_interval=10, **forward_kwargs):
+        self.model = model
+        self.forward_kwargs = forward_kwargs
+        self.reuse_features = hasattr(model, 'encode') and hasattr(model, 'decode')
+        if warm_start_level is not None:
+            assert hasattr(model, 'warm_start'), 'warm start is only supported by pwcnet'
+            assert 2 <= warm_start_level <= 5, 'the warm start level should be between 2 and 5'
+            assert forward_kwargs.get('exit_level', 2) <= warm_start_level, 'cannot exit before the warm start level'
+        self.warm_start_level = warm_start_level
+        self.refresh_interval = refresh_interval
+        self.previous = None
+        self.estimates = None
+        self.warm_pairs = 0
+        self.frames_encoded = 0
+
+    def reset(self):
+        """forget the previous frame, e.g. at a scene cut"""
+        self.previous = None
+        self.estimates = None
+
+    @torch.no_grad()
+    def push(self, frame):
+        """feeds the next frame (B x 3 x H x W), returns the flow from the previous frame to it, or None for the first frame"""
+        if self.reuse_features:
+            current = self.model.encode(frame)
+            self.frames_encoded += 1
+        else:
+            current = frame
+
+        flow = None
+        if self.previous is not None:
+            if self.warm_start_level is not None:
+                flow = self._decode_warm(current)
+            elif self.reuse_features:
+                flow = self.model.decode(self.previous, current, **self.forward_kwargs)
+            else:
+                flow = self.model(torch.cat([self.previous, current], 1), **self.forward_kwargs)
+
+        self.previous = current
+        return flow
+
+    def _decode_warm(self, current):
+        kwargs = dict(self.forward_kwargs)
+        estimates = {}
+        if self.estimates is not None and self.warm_pairs < self.refresh_interval:
+            kwargs['init'] = self.model.warm_start(self.estimates, self.warm_start_level)
+            kwargs['init_level'] = self.warm_start_level
+            self.warm_pairs += 1
+        else:
+            self.warm_pairs = 0
+
+        flow = self.model.decode(self.previous, current, estimates=estimates, **kwargs)
+
+        # only keep what warm_start needs, not the dense features of every decoder
+        finest = min(estimates)
+        self.estimates = {finest: {'tenFlow': estimates[finest]['tenFlow']}}
+        self.estimates.setdefault(self.warm_start_level, {})['tenUpfeat'] = estimates[self.warm_start_level]['tenUpfeat']
+        return flow
@@ -0,0 +1,117 @@
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+
+def tile_starts(size, tile, stride):
+    """start offsets of tiles of length `tile` covering [0, size), the last tile is aligned to the end"""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def feather(length, before, after, overlap, margin, device):
+    """1D blending weights of a tile: zero on the `margin` pixels next to an inner border, then a linear ramp
+    up to `overlap` pixels. Borders of the image (before/after False) keep full weight."""
+    weights = torch.ones(length, device=device)
+    ramp = ((torch.arange(overlap, device=device, dtype=torch.float32) - margin + 1) / (overlap - margin)).clamp(0, 1)
+    n = min(overlap, length)
+    if before:
+        weights[:n] = torch.min(weights[:n], ramp[:n])
+    if after:
+        weights[-n:] = torch.min(weights[-n:], ramp[:n].flip(0))
+    return weights
+
+
+def activation_bytes(model, input, **forward_kwargs):
+    """upper bound of the activation memory of one forward pass: the sum of the outputs of all leaf modules"""
+    total = [0]
+    handles = []
+
+    def hook(module, input, output):
+        if torch.is_tensor(output):
+            total[0] += output.numel() * output.element_size()
+
+    for module in model.modules():
+        if len(list(module.children())) == 0:
+            handles.append(module.register_forward_hook(hook))
+    with torch.no_grad():
+        model(input, **forward_kwargs)
+    for handle in handles:
+        handle.remove()
+    return total[0] + input.numel() * input.element_size()
+
+
+class TiledInference(object):
+    """Runs a flow network on overlapping tiles of a large image pair and blends the tiles back together.
+
+    Every tile is predicted independently, upsampled to the tile resolution and blended with feathered
+    weights: the `margin` pixels next to an inner tile border, which lack spatial context, are discarded,
+    the rest of the overlap is linearly cross-faded. Tiles are batched, the batch size is derived from
+    `memory_budget` (in MB) using the activation size of a single tile.
+
+    Args:
+        model: a flow network in eval mode, taking B x 6 x H x W inputs
+        tile_size: (height, width) of a tile, preferably multiples of 64
+        overlap: number of pixels shared by two neighbouring tiles
+        margin: number of pixels discarded next to inner tile borders, defaults to overlap // 4
+        memory_budget: activation memory in MB available for one batch of tiles, None for one tile per batch
+        forward_kwargs: extra arguments for the model, e.g. exit_level
+    """
+
+    def __init__(self, model, tile_size=(384, 512), overlap=128, margin=None, memory_budget=None, **forward_kwargs):
+        self.model = model
+        self.tile_size = tuple(tile_size)
+        self.overlap = overlap
+        self.margin = overlap // 4 if margin is None else margin
+        assert 2 * self.margin < self.overlap, 'the margin should be smaller than half of the overlap'
+        assert self.overlap < min(self.tile_size), 'the overlap should be smaller than the tiles'
+        self.memory_budget = memory_budget
+        self.forward_kwargs = forward_kwargs
+        self.batch_size = None
+
+    def _batch_size(self, tile):
+        if self.batch_size is None:
+            if self.memory_budget is None:
+                self.batch_size = 1
+            else:
+                per_tile = activation_bytes(self.model, tile, **self.forward_kwargs) / 2**20
+                self.batch_size = max(1, int(self.memory_budget // per_tile))
+                if per_tile > self.memory_budget:
+                    warnings.warn('a single {}x{} tile needs about {:.0f} MB, more than the budget of {} MB, '
+                                  'consider smaller tiles'.format(*self.tile_size, per_tile, self.memory_budget))
+        return self.batch_size
+
+    def tiles(self, height, width):
+        """(top, left, tile height, tile width) of all tiles of a height x width image"""
+        tile_h, tile_w = min(self.tile_size[0], height), min(self.tile_size[1], width)
+        return [(top, left, tile_h, tile_w)
+                for top in tile_starts(height, tile_h, tile_h - self.overlap)
+                for left in tile_starts(width, tile_w, tile_w - self.overlap)]
+
+    @torch.no_grad()
+    def __call__(self, input):
+        """input: 1 x 6 x H x W image pair, returns the 1 x 2 x H x W flow at full resolution"""
+        assert input.size(0) == 1, 'tiled inference works on one image pair at a time'
+        _, _, height, width = input.size()
+        flow = input.new_zeros(1, 2, height, width)
+        weights = input.new_zeros(1, 1, height, width)
+
+        tiles = self.tiles(height, width)
+        batch_size = self._batch_size(input[:, :, :tiles[0][2], :tiles[0][3]])
+        for i in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[i:i + batch_size]
+            batch = torch.cat([input[:, :, top:top + h, left:left + w] for top, left, h, w in batch_tiles])
+            output = self.model(batch, **self.forward_kwargs)
+            output = F.interpolate(output, size=batch.size()[-2:], mode='bilinear', align_corners=False)
+
+            for tile_flow, (top, left, h, w) in zip(output, batch_tiles):
+                weight_y = feather(h, top > 0, top + h < height, self.overlap, self.margin, input.device)
+                weight_x = feather(w, left > 0, left + w < width, self.overlap, self.margin, input.device)
+                weight = (weight_y.view(-1, 1) * weight_x.view(1, -1)).to(flow.dtype)
+                flow[0, :, top:top + h, left:left + w] += tile_flow * weight
+                weights[0, :, top:top + h, left:left + w] += weight
+
+        return flow / weights.clamp(min=1e-6)
@@ -1,13 +1,240 @@
+import collections
+import glob
 import os
+import random
 import numpy as np
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from imageio import imwrite
+from checkpoint import EXTENSION, save_file
+
+def link_or_copy(src, dst):
+    """atomically makes dst a hard link to src, or a copy on file systems without hard links"""
+    tmp_dst = dst + '.tmp'
+    if os.path.lexists(tmp_dst):
+        os.remove(tmp_dst)
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def write_state(state, path):
+    """atomically writes state in the .pth.tar or .safetensors format, depending on the extension of path.
+    The state is written to a new file that replaces path, links to the previous file are left untouched"""
+    tmp_path = path + '.tmp'
+    if path.endswith(EXTENSION):
+        save_file(state, tmp_path)
+    else:
+        torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def best_filename(filename):
+    return 'model_best' + (EXTENSION if filename.endswith(EXTENSION) else '.pth.tar')
+
 
 def save_checkpoint(state, is_best, save_path, filename='checkpoint.pth.tar'):
-    torch.save(state, os.path.join(save_path,filename))
+    """saves state in the .pth.tar or .safetensors format, depending on the extension of filename.
+    The best checkpoint is a hard link named model_best with the same extension"""
+    path = os.path.join(save_path,filename)
+    write_state(state, path)
     if is_best:
-        shutil.copyfile(os.path.join(save_path,filename), os.path.join(save_path,'model_best.pth.tar'))
+        link_or_copy(path, os.path.join(save_path,best_filename(filename)))
+
+
+def snapshot(state):
+    """copy of a (nested) checkpoint dict with all tensors copied to CPU memory"""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter(object):
+    """Saves checkpoints in a background thread.
+
+    save() only blocks on copying the state to CPU memory, serialization and writing happen on a
+    worker thread while training goes on. Every checkpoint is written to checkpoint_{epoch:04d}{ext}
+    through a temporary file and a rename, so a crash never leaves a truncated checkpoint. checkpoint{ext}
+    and model_best{ext} are hard links to the latest and the best one, and only the `keep` latest
+    checkpoints are kept besides the best. At most `max_pending` snapshots wait to be written, errors of
+    the worker are raised by a later save() or by close().
+
+    Args:
+        save_path: folder of the checkpoints
+        keep: number of latest checkpoints to keep
+        extension: '.pth.tar' or '.safetensors'
+        max_pending: number of snapshots that can wait to be written before save() blocks
+    """
+
+    def __init__(self, save_path, keep=3, extension='.pth.tar', max_pending=2):
+        self.save_path = save_path
+        self.keep = keep
+        self.extension = extension
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = collections.deque()
+
+    def _submit(self, fn, *args):
+        # bound the number of snapshots waiting to be written
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def save(self, state, is_best, epoch):
+        self._submit(self._write, snapshot(state), is_best, epoch)
+
+    def save_training_state(self, state, filename='snapshot.pth.tar'):
+        """writes the full training state to a single file that is atomically replaced, always in the torch
+        format since optimizer states are not flat dicts of tensors"""
+        self._submit(write_state, snapshot(state), os.path.join(self.save_path, filename))
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def _write(self, state, is_best, epoch):
+        path = os.path.join(self.save_path, 'checkpoint_{:04d}{}'.format(epoch, self.extension))
+        write_state(state, path)
+        link_or_copy(path, os.path.join(self.save_path, 'checkpoint' + self.extension))
+        if is_best:
+            link_or_copy(path, os.path.join(self.save_path, best_filename(self.extension)))
+
+        checkpoints = sorted(glob.glob(os.path.join(self.save_path, 'checkpoint_*' + self.extension)))
+        for old in checkpoints[:-self.keep] if self.keep > 0 else checkpoints:
+            os.remove(old)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """Shuffles a dataset with a permutation given by (seed, epoch), and can start in the middle of an epoch.
+
+    Yields (index, sample seed) pairs for a SeededDataset: the random augmentations of every sample only
+    depend on the seed, the epoch and its position in the epoch, not on the data loading workers, so a
+    resumed epoch sees exactly the samples and augmentations it would have seen without interruption.
+
+    For distributed training, every one of the `num_replicas` processes creates a sampler with its `rank`:
+    the permutation is padded to a multiple of num_replicas by repeating its first samples, and each process
+    takes every num_replicas-th sample from position `rank`, so that all processes run the same number of
+    batches. `start` then counts the samples already seen by each process.
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = -(-len(data_source) // num_replicas)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start: number of samples of the epoch already seen, by this process"""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(hash((self.seed, self.epoch)) & 0x7fffffff)
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+        order += order[:self.num_samples * self.num_replicas - len(order)]
+        for position in range(self.rank + self.start * self.num_replicas, len(order), self.num_replicas):
+            yield order[position], hash((self.seed, self.epoch, position)) & 0xffffffff
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    """Seeds the python and numpy random generators used by the co-transforms before loading every sample"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, item):
+        index, seed = item
+        random.seed(seed)
+        np.random.seed(seed)
+        return self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def setup_for_distributed(is_master):
+    """disables print in the processes other than the master one, print(..., force=True) still prints"""
+    import builtins
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+class NullWriter(object):
+    """stands in for a SummaryWriter in the processes that do not log"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class CompiledStep(object):
+    """fn compiled with torch.compile, one graph per configuration: the values fn reads from dicts and globals
+    are guarded, so changing them compiles a new graph. Falls back to running fn eagerly for the rest of the run
+    if torch.compile is not available or fails, after printing why"""
+
+    def __init__(self, fn, **compile_kwargs):
+        self.fn = fn
+        self.compiled = None
+        self.compile_errors = ()
+        # the first call compiles the graphs
+        self.calls = 0
+        if hasattr(torch, 'compile'):
+            self.compiled = torch.compile(fn, **compile_kwargs)
+            import torch._dynamo.exc
+            # failures to capture or compile a graph, the names vary between torch versions
+            self.compile_errors = tuple(getattr(torch._dynamo.exc, name) for name in [
+                'BackendCompilerFailed', 'Unsupported', 'TorchRuntimeError', 'InternalTorchDynamoError'] if hasattr(torch._dynamo.exc, name))
+        else:
+            print('=> torch.compile is not available in torch {}, running the step eagerly'.format(torch.__version__))
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except self.compile_errors as e:
+                # errors of the step itself are raised again by the eager call, any other error is not caught
+                print('=> compiling the step failed, running it eagerly: {}: {}'.format(type(e).__name__, e))
+                self.compiled = None
+        return self.fn(*args, **kwargs)
 
 
 class AverageMeter(object):
@@ -36,7 +263,7 @@ def flow2rgb(flow_map, max_value=None):
     if type(flow_map) is not np.ndarray:
         flow_map_np = flow_map.detach().cpu().numpy()
     else:
-        flow_map_np = flow_map
+        flow_map_np = flow_map.copy()
 
     _, h, w = flow_map_np.shape
     flow_map_np[:,(flow_map_np[0] == 0) & (flow_map_np[1] == 0)] = float('nan')
@@ -51,6 +278,59 @@ def flow2rgb(flow_map, max_value=None):
     return rgb_map.clip(0,1)
 
 
+
+def make_colorwheel():
+    """Middlebury color wheel, ncols x 3 RGB values in [0, 1] (Baker et al., A Database and Evaluation
+    Methodology for Optical Flow, ICCV 2007)"""
+    RY, YG, GC, CB, BM, MR = 15, 6, 4, 11, 13, 6
+    ramps = [(RY, 0, 1), (YG, 1, 0), (GC, 1, 2), (CB, 2, 1), (BM, 2, 0), (MR, 0, 2)]
+    colorwheel = np.zeros((sum(n for n, _, _ in ramps), 3), np.float32)
+    col = 0
+    # every segment keeps one channel at 1 and ramps another one up or down
+    for i, (n, full, ramp) in enumerate(ramps):
+        colorwheel[col:col + n, full] = 1
+        colorwheel[col:col + n, ramp] = np.arange(n) / n if i % 2 == 0 else 1 - np.arange(n) / n
+        col += n
+    return colorwheel
+
+
+_colorwheels = {}
+
+
+def flow_to_color(flow, max_value=None):
+    """Colors a batch of B x 2 x H x W flows with the Middlebury color wheel, on the device of `flow`.
+
+    The hue encodes the direction, the saturation the magnitude relative to `max_value`, or to the
+    largest magnitude of each flow map if not set. Larger magnitudes are darkened, zero and invalid
+    (non finite) flows are white. The input is not modified. Returns B x 3 x H x W uint8 images.
+    """
+    key = flow.device
+    if key not in _colorwheels:
+        _colorwheels[key] = torch.from_numpy(make_colorwheel()).to(flow.device)
+    colorwheel = _colorwheels[key]
+    ncols = colorwheel.size(0)
+
+    flow = flow.detach().float()
+    flow = torch.where(torch.isfinite(flow), flow, torch.zeros_like(flow))
+    u, v = flow[:, 0], flow[:, 1]
+    rad = torch.sqrt(u * u + v * v)
+    if max_value is None:
+        max_value = rad.flatten(1).max(1)[0].view(-1, 1, 1)
+    rad = rad / (max_value + 1e-5) if torch.is_tensor(max_value) else rad / max_value
+
+    fk = (torch.atan2(-v, -u) / np.pi + 1) / 2 * (ncols - 1)
+    k0 = fk.floor().long()
+    f = (fk - k0.float()).unsqueeze(1)
+    k1 = (k0 + 1) % ncols
+    col0 = colorwheel[k0].permute(0, 3, 1, 2)
+    col1 = colorwheel[k1].permute(0, 3, 1, 2)
+    col = (1 - f) * col0 + f * col1
+
+    rad = rad.unsqueeze(1)
+    col = torch.where(rad <= 1, 1 - rad * (1 - col), col * 0.75)
+    return (255 * col).round().to(torch.uint8)
+
+
 def save_image(image, file_name='default.png'):
     # convert from tensor to numpy array
     if torch.is_tensor(image):